@@ -1,34 +1,69 @@
-import boto3
 import botocore
 # import jsonschema
 import json
+import hashlib
 import traceback
 from botocore.exceptions import ClientError
 
-from extutil import remove_none_attributes, account_context, ExtensionHandler, \
-    ext, component_safe_name, handle_common_errors
+from extutil import remove_none_attributes, account_context, ContextExtensionHandler, get_client, \
+    component_def_error, ext, run_batch, component_safe_name, handle_common_errors, normalize_policy_document, \
+    diff_policy_documents, run_concurrently, compact_json, policy_document_errors, \
+    policy_document_size, diff_tags, write_tags, delete_tags, paginate, \
+    log, summarize_response, out_of_time, deferred_items, DeadlineReached, summary_error, MAX_MANAGED_POLICY_CHARS
 
-eh = ExtensionHandler()
+eh = ContextExtensionHandler()
+# Built once during init, rather than inside the first op or event
+get_client("iam")
+
+MAX_POLICY_VERSIONS = 5
+POLICY_LOG_KEYS = ["Arn", "PolicyName", "PolicyId", "DefaultVersionId", "AttachmentCount", "UpdateDate"]
+DETACH_CONCURRENCY = 8
 
 def lambda_handler(event, context):
+    if "batch" in event:
+        return run_batch(lambda_handler, event, context)
+
     try:
-        print(f"event = {event}")
+        log("DEBUG", "Event", event=event)
         account_number = account_context(context)['number']
         region = account_context(context)['region']
-        eh.capture_event(event)
+        eh.capture_event(event, context)
         prev_state = event.get("prev_state")
         cdef = event.get("component_def")
+        if event.get("op") == "upsert":
+            input_error = component_def_error("policy", cdef)
+            if input_error:
+                eh.add_log("Invalid Component Definition", {"error": input_error}, True)
+                eh.perm_error(f"Invalid Component Definition: {input_error}", 0)
+                return eh.finish()
+
         cname = event.get("component_name")
         project_code = event.get("project_code")
         repo_id = event.get("repo_id")
-        document = cdef.get("document")
-        policy_hash = json.dumps(document, sort_keys=True)
         policy_name = cdef.get("name") or component_safe_name(project_code, repo_id, cname)
         path = "/cloudkommand/" #Not sure how well this is supported, probably poorly
         policy_arn = gen_iam_policy_arn(policy_name, account_number, path)
         pass_back_data = event.get("pass_back_data", {})
         description = cdef.get("description") or "This policy was created by CloudKommand"
         tags = cdef.get("tags") or {}
+        shards = []
+        if event.get("op") == "upsert":
+            document_errors = policy_document_errors(cdef.get("document"), max_chars=None if cdef.get("shard") else MAX_MANAGED_POLICY_CHARS)
+            if not document_errors and cdef.get("shard"):
+                # The first shard is managed as the policy itself, the rest by the shard ops
+                shards = gen_shards(cdef.get("document"), policy_name, account_number, path)
+                document_errors = [
+                    f"Shard {i}: {error}" for i, shard in enumerate(shards)
+                    for error in policy_document_errors(shard['document'], max_chars=MAX_MANAGED_POLICY_CHARS)
+                ]
+            if document_errors:
+                eh.add_log("Invalid Policy Document", {"errors": document_errors}, True)
+                eh.perm_error(f"Invalid Policy Document: {'; '.join(document_errors)}", 0)
+                return eh.finish()
+
+        document = shards[0]['document'] if shards else cdef.get("document")
+        policy_hash = compact_json(document)
+        document_hash = gen_document_hash(document) if document else None
         if pass_back_data:
             pass
         elif event.get("op") == "upsert":
@@ -36,37 +71,58 @@ def lambda_handler(event, context):
             #     eh.add_op("create_policy")
             # else:
             eh.add_op("get_policy")
+            plan_shards(prev_state, shards, tags)
 
         elif event.get("op") == "delete":
+            old_shard_arns = (prev_state.get("props", {}).get("shard_arns") or [])[1:]
+            if old_shard_arns:
+                eh.add_op("remove_shards", {arn: {"arn": arn} for arn in old_shard_arns})
             eh.add_op("remove_policy", {"arn":prev_state.get("props", {}).get("arn") or policy_arn, "complete": True})
         
-        get_policy(prev_state, policy_name, policy_hash, policy_arn, tags)
-        create_policy(policy_name, description, path, policy_hash, account_number,tags)
-        create_policy_version(policy_arn, policy_name, policy_hash)
+        if shards:
+            eh.add_props({
+                "shard_arns": [shard['arn'] for shard in shards],
+                "shard_hashes": [shard['hash'] for shard in shards],
+                "shard_tags_hash": gen_tags_hash(tags)
+            })
+
+        get_policy(prev_state, policy_name, document, document_hash, policy_arn, tags)
+        create_policy(policy_name, description, path, policy_hash, document_hash, account_number,tags)
+        create_policy_version(policy_arn, policy_name, policy_hash, document_hash)
         remove_tags(policy_arn)
-        add_tags(policy_arn, tags)
+        add_tags(policy_arn)
+        sync_shards(shards, description, path, tags)
+        sync_shard_tags(shards, tags)
+        remove_shards()
         remove_policy()
             
         return eh.finish()
 
     except Exception as e:
         msg = traceback.format_exc()
-        print(msg)
         eh.add_log("Unexpected Error", {"error": msg}, is_error=True)
         eh.declare_return(200, 0, error_code=str(e))
         return eh.finish()
 
 @ext(handler=eh, op="create_policy_version")
-def create_policy_version(policy_arn, policy_name, policy_hash):
-    iam_client = boto3.client("iam")
+def create_policy_version(policy_arn, policy_name, policy_hash, document_hash):
+    iam_client = get_client("iam")
+    op_info = eh.ops['create_policy_version']
+    versions = op_info.get("versions") if isinstance(op_info, dict) else None
 
     try:
+        if versions is None:
+            versions = list_policy_version_slots(iam_client, policy_arn)
+            eh.add_op("create_policy_version", {"versions": versions})
+        free_policy_version_slot(iam_client, policy_arn, versions)
+
         policy_response = iam_client.create_policy_version(
             PolicyArn=policy_arn,
             PolicyDocument=policy_hash,
             SetAsDefault=True
         )
-        eh.add_log("Created New Policy Version", policy_response)
+        version_id = policy_response['PolicyVersion']['VersionId']
+        eh.add_log("Created New Policy Version", summarize_response(policy_response['PolicyVersion'], ["VersionId", "IsDefaultVersion"]))
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchEntity':
             eh.add_op("create_policy")
@@ -74,33 +130,27 @@ def create_policy_version(policy_arn, policy_name, policy_hash):
             eh.complete_op("create_policy_version")
             eh.retry_error("Policy Does Not Exist, Retrying Create", 0)
             return 0
+        elif e.response['Error']['Code'] == 'LimitExceeded':
+            # Someone else created a version since we listed them, so list again next time
+            eh.add_log("Policy Version Limit Hit", {"arn": policy_arn, "versions": versions})
+            eh.add_op("create_policy_version")
+            eh.retry_error("Policy Version Limit Hit", 0)
+            return 0
         else:
             eh.add_log("Error in Creating Policy Version", {"error": str(e)}, is_error=True)
             if e.response['Error']['Code'] == 'MalformedPolicyDocument':
                 eh.declare_return(200, 0, error_code=str(e), error_details={"policy": policy_hash}, callback=False)
                 return 0
             else:
-                print(e.response['Error']['Code'])
+                log("ERROR", "Unhandled Error Code", error_code=e.response['Error']['Code'])
                 raise e
 
-    try:
-        response = iam_client.list_policy_versions(
-            PolicyArn=policy_arn,
-            MaxItems=10
-        )
-        existing_versions = response['Versions']
-        for version in existing_versions:
-            if not version.get("IsDefaultVersion"):
-                response = iam_client.delete_policy_version(
-                    PolicyArn=policy_arn,
-                    VersionId=version.get("VersionId")
-                )
-                eh.add_log("Deleting Old Policy Version", response)
-            
-    except Exception as e:     
-        eh.add_log("Error in Deleting Old Policy Versions", {"error": str(e)}, is_error=True)
-
-    eh.add_props({"arn": policy_arn, "name": policy_name})
+    eh.add_props({
+        "arn": policy_arn,
+        "name": policy_name,
+        "document_hash": document_hash,
+        "version_id": version_id
+    })
     eh.add_links({"Policy": gen_iam_policy_link(policy_arn)})
 
     # eh.complete_op("create_policy_version")
@@ -108,9 +158,9 @@ def create_policy_version(policy_arn, policy_name, policy_hash):
 
 
 @ext(handler=eh, op="create_policy")
-def create_policy(policy_name, description, path, policy_hash, account_number, tags):
+def create_policy(policy_name, description, path, policy_hash, document_hash, account_number, tags):
 
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
     try:
         result = iam_client.create_policy(**remove_none_attributes({
             "PolicyName": policy_name,
@@ -120,12 +170,13 @@ def create_policy(policy_name, description, path, policy_hash, account_number, t
             "Tags": format_tags(tags) or None
         }))
 
-        eh.add_log("Created Policy", result)
+        eh.add_log("Created Policy", summarize_response(result['Policy'], POLICY_LOG_KEYS))
 
         eh.add_props({
             "arn": result["Policy"]["Arn"],
             "name": policy_name,
-            # "policy_hash": policy_hash
+            "document_hash": document_hash,
+            "version_id": result["Policy"].get("DefaultVersionId")
         })
 
         eh.add_links({"Policy": gen_iam_policy_link(result["Policy"]["Arn"])})
@@ -145,63 +196,89 @@ def create_policy(policy_name, description, path, policy_hash, account_number, t
     # eh.complete_op("create_policy")
 
 @ext(handler=eh, op="get_policy")
-def get_policy(prev_state, policy_name, policy_hash, policy_arn, tags):
+def get_policy(prev_state, policy_name, document, document_hash, policy_arn, tags):
     try:
         old_policy_arn = prev_state["props"]["arn"]
         old_policy_name = prev_state["props"]["name"]
-        # old_policy_hash = prev_state["props"]["policy_hash"]
+        old_document_hash = prev_state["props"].get("document_hash")
+        old_version_id = prev_state["props"].get("version_id")
     except:
         prev_state = None
         old_policy_arn = None
         old_policy_name = None
-        # old_policy_hash = None
+        old_document_hash = None
+        old_version_id = None
 
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
     # if old_policy_arn:
     try:
         policy_response = iam_client.get_policy(PolicyArn=policy_arn)
-        eh.add_log("Got Existing Policy", policy_response)
+        eh.add_log("Got Existing Policy", summarize_response(policy_response['Policy'], POLICY_LOG_KEYS))
         if policy_name != old_policy_name:
             eh.add_op("remove_old", {"arn": old_policy_arn, "complete": False})
             eh.add_op("create_policy")
         else:
-            eh.add_op("create_policy_version")
-            current_tags = unformat_tags(policy_response['Policy'].get("Tags"))
-            if tags != current_tags:
-                remove_tags = [k for k in current_tags.keys() if k not in tags]
-                add_tags = {k:v for k,v in tags.items() if k not in current_tags.keys()}
-                if remove_tags:
-                    eh.add_op("remove_tags", remove_tags)
-                if add_tags:
-                    eh.add_op("add_tags", add_tags)
+            default_version_id = policy_response['Policy'].get("DefaultVersionId")
+            if old_document_hash and (document_hash == old_document_hash) and (default_version_id == old_version_id):
+                # Same document and nobody has pushed a new default version since we last wrote it
+                eh.add_log("Policy Document Unchanged", {"arn": policy_arn, "version_id": default_version_id})
+                eh.add_props({
+                    "arn": policy_arn,
+                    "name": policy_name,
+                    "document_hash": document_hash,
+                    "version_id": default_version_id
+                })
+                eh.add_links({"Policy": gen_iam_policy_link(policy_arn)})
+            else:
+                # A read is much cheaper than the create/list/delete version writes
+                version_response = iam_client.get_policy_version(
+                    PolicyArn=policy_arn,
+                    VersionId=default_version_id
+                )
+                document_diff = diff_policy_documents(version_response['PolicyVersion']['Document'], document)
+                if document_diff:
+                    eh.add_log("Policy Document Changed", document_diff)
+                    eh.add_op("create_policy_version")
+                else:
+                    eh.add_log("Policy Document Equivalent", {"arn": policy_arn, "version_id": default_version_id})
+                    eh.add_props({
+                        "arn": policy_arn,
+                        "name": policy_name,
+                        "document_hash": document_hash,
+                        "version_id": default_version_id
+                    })
+                    eh.add_links({"Policy": gen_iam_policy_link(policy_arn)})
+            current_tags = unformat_tags(policy_response['Policy'].get("Tags") or [])
+            add_tags, remove_tags = diff_tags(current_tags, tags)
+            if remove_tags:
+                eh.add_op("remove_tags", remove_tags)
+            if add_tags:
+                eh.add_op("add_tags", add_tags)
 
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchEntity':
             eh.add_op("create_policy")
         else:
-            eh.add_log("Get Policy Failed", e.response, is_error=True)
-            eh.declare_return(200, 0, error_message="get_policy_failed", callback_sec=4)
+            eh.add_log("Get Policy Failed", summarize_response(e.response), is_error=True)
+            eh.retry_error(str(e), 0)
     # else:
     #     eh.add_op("create_policy")
 
 @ext(handler=eh, op="add_tags")
-def add_tags(policy_arn, tags):
-    iam_client = boto3.client("iam")
-
-    formatted_tags = format_tags(tags)
+def add_tags(policy_arn):
+    iam_client = get_client("iam")
+    tags = eh.ops['add_tags']
 
     try:
-        response = iam_client.tag_policy(
-            PolicyArn=policy_arn,
-            Tags=formatted_tags
-        )
-        eh.add_log("Tags Set", response)
+        written = dict(tags)
+        write_tags(lambda batch: iam_client.tag_policy(PolicyArn=policy_arn, Tags=batch), tags)
+        eh.add_log("Tags Set", {"tags": written})
 
     except ClientError as e:
-        if e.response['Error']['Code'] in ["LimitExceededException"]:
+        if e.response['Error']['Code'] in ["LimitExceeded", "LimitExceededException"]:
             eh.add_log("Tag Limit Hit", {"tags": tags, "policy_arn": policy_arn}, True)
             eh.perm_error("Tag Limit Hit", 70)
-        elif e.response['Error']['Code'] in ["InvalidInputException"]:
+        elif e.response['Error']['Code'] in ["InvalidInput", "InvalidInputException"]:
             eh.add_log("Invalid Tags", {"tags": tags, "policy_arn": policy_arn}, True)
             eh.perm_error("Invalid Tags", 70)
         else:
@@ -211,20 +288,19 @@ def add_tags(policy_arn, tags):
 
 @ext(handler=eh, op="remove_tags")
 def remove_tags(policy_arn):
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
     remove_tags = eh.ops['remove_tags']
 
     try:
-        iam_client.untag_policy(
-            PolicyArn=policy_arn,
-            TagKeys=remove_tags
-        )
-        eh.add_log("Tags Removed", {"tags_removed": remove_tags})
+        removed = list(remove_tags)
+        delete_tags(lambda batch: iam_client.untag_policy(PolicyArn=policy_arn, TagKeys=batch), remove_tags)
+        eh.add_log("Tags Removed", {"tags_removed": removed})
 
     except ClientError as e:
         eh.add_log("Remove Tags Error", {"error": str(e)}, True)
         eh.retry_error(str(e), 85)
 
+
 #This may be different with "paths"
 def gen_iam_policy_arn(policy_name, account_number, path="/"):
     #arn:aws:iam::227993477930:policy/3aba481ac88bcbc5d94567e9f93339a7-iam
@@ -234,6 +310,78 @@ def gen_iam_policy_arn(policy_name, account_number, path="/"):
 def gen_iam_policy_link(policy_arn):
     return f"https://console.aws.amazon.com/iam/home?region=us-east-1#/policies/{policy_arn}$serviceLevelSummary"
 
+def list_policy_version_slots(iam_client, policy_arn):
+    """Returns the versions of a policy, oldest first"""
+    versions = [
+        {"id": v['VersionId'], "default": v.get("IsDefaultVersion", False)}
+        for v in paginate(iam_client.list_policy_versions, "Versions", PolicyArn=policy_arn)
+    ]
+    return sorted(versions, key=lambda x: int(x['id'].lstrip("v")))
+
+def free_policy_version_slot(iam_client, policy_arn, versions):
+    """Deletes the oldest non-default version, only if the policy is at its version limit.
+    Mutates versions so that the slot state carried in ops stays accurate"""
+    if len(versions) < MAX_POLICY_VERSIONS:
+        return None
+
+    oldest = next(v for v in versions if not v['default'])
+    try:
+        iam_client.delete_policy_version(
+            PolicyArn=policy_arn,
+            VersionId=oldest['id']
+        )
+        eh.add_log("Deleted Oldest Policy Version", {"arn": policy_arn, "version_id": oldest['id']})
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise e
+    versions.remove(oldest)
+
+def gen_shards(document, policy_name, account_number, path):
+    shards = []
+    for index, shard_document in enumerate(shard_policy_document(document)):
+        shard_name = f"{policy_name}-shard-{index}" if index else policy_name
+        shards.append({
+            "name": shard_name,
+            "arn": gen_iam_policy_arn(shard_name, account_number, path),
+            "document": shard_document,
+            "hash": gen_document_hash(shard_document)
+        })
+    return shards
+
+def shard_policy_document(document, max_chars=MAX_MANAGED_POLICY_CHARS):
+    """Packs the statements of document into as few documents of at most 
+    max_chars as it can (first fit decreasing). A single statement that 
+    is too big on its own is left for IAM to reject"""
+    statements = document.get("Statement") or []
+    if isinstance(statements, dict):
+        statements = [statements]
+    base = {k: v for k, v in document.items() if k != "Statement"}
+    overhead = policy_document_size({**base, "Statement": []})
+
+    sized_statements = sorted(
+        ((policy_document_size(statement), i, statement) for i, statement in enumerate(statements)),
+        key=lambda x: (-x[0], x[1])
+    )
+    bins = []
+    for size, i, statement in sized_statements:
+        for b in bins:
+            if b['size'] + size + 1 <= max_chars:
+                b['size'] += size + 1
+                b['statements'].append((i, statement))
+                break
+        else:
+            bins.append({"size": overhead + size, "statements": [(i, statement)]})
+
+    # Keep the author's statement order within each shard
+    return [
+        {**base, "Statement": [statement for _, statement in sorted(b['statements'], key=lambda x: x[0])]}
+        for b in bins
+    ] or [document]
+
+def gen_document_hash(document):
+    normalized = json.dumps(normalize_policy_document(document), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
 def format_tags(tags_dict):
     return [{"Key": k, "Value": v} for k,v in tags_dict.items()]
 
@@ -242,118 +390,226 @@ def unformat_tags(tags_list):
 
 @ext(handler=eh, op="remove_policy")
 def remove_policy():
-    op_info = eh.ops['remove_policy']
-    policy_arn = op_info['arn']
-    complete = op_info['complete']
+    iam_client = get_client("iam")
+    teardown_policy(iam_client, eh.ops['remove_policy'])
 
-    iam_client = boto3.client("iam")
-    try:
-        iam_client.get_policy(
-            PolicyArn = policy_arn
-        )
+@ext(handler=eh, op="remove_shards")
+def remove_shards():
+    iam_client = get_client("iam")
+    pending = eh.ops['remove_shards']
 
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == 'NoSuchEntity':
-            eh.add_log("Old Policy Doesn't Exist", {"policy_arn": policy_arn})
-            eh.complete_op("remove_policy")
-            if complete:
-                eh.declare_return(200, 100, success=True)
+    for shard_arn in list(pending):
+        if not teardown_policy(iam_client, pending[shard_arn]):
             return None
-        else:
-            raise e
+        del pending[shard_arn]
 
-    policy_groups, policy_users, policy_roles = get_all_entities_for_policy(policy_arn)
+@ext(handler=eh, op="sync_shards")
+def sync_shards(shards, description, path, tags):
+    iam_client = get_client("iam")
+    pending = eh.ops['sync_shards']
 
-    for group in policy_groups:
+    for index in list(pending):
+        if out_of_time():
+            eh.continue_later(80)
+            return 0
+        shard = shards[index]
+        policy_hash = compact_json(shard['document'])
         try:
-            response = iam_client.detach_group_policy(
-                GroupName = group.get("GroupName"),
-                PolicyArn = policy_arn
-            )
-            eh.add_log("Detaching From Group", response)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchEntityException':
-                pass
+            iam_client.create_policy(**remove_none_attributes({
+                "PolicyName": shard['name'],
+                "Description": description,
+                "Path": path,
+                "PolicyDocument": policy_hash,
+                "Tags": format_tags(tags) or None
+            }))
+            eh.add_log("Created Policy Shard", {"arn": shard['arn']})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'EntityAlreadyExists':
+                versions = list_policy_version_slots(iam_client, shard['arn'])
+                free_policy_version_slot(iam_client, shard['arn'], versions)
+                iam_client.create_policy_version(
+                    PolicyArn=shard['arn'],
+                    PolicyDocument=policy_hash,
+                    SetAsDefault=True
+                )
+                reconcile_policy_tags(iam_client, shard['arn'], tags)
+                eh.add_log("Updated Policy Shard", {"arn": shard['arn']})
+            elif e.response['Error']['Code'] == 'MalformedPolicyDocument':
+                eh.add_log("Policy Shard Invalid", {"error": str(e)}, is_error=True)
+                eh.declare_return(200, 0, error_code=str(e), error_details={"policy": policy_hash}, callback=False)
+                return 0
             else:
                 raise e
+        pending.remove(index)
 
-    for user in policy_users:
-        try:
-            response = iam_client.detach_user_policy(
-                UserName = user.get("UserName"),
-                PolicyArn = policy_arn
-            )
-            eh.add_log("Detaching From User", response)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchEntityException':
-                pass
-            else:
-                raise e
+@ext(handler=eh, op="sync_shard_tags")
+def sync_shard_tags(shards, tags):
+    iam_client = get_client("iam")
+    pending = eh.ops['sync_shard_tags']
 
-    for role in policy_roles:
+    for index in list(pending):
+        if out_of_time():
+            eh.continue_later(82)
+            return 0
         try:
-            response = iam_client.detach_role_policy(
-                RoleName = role.get("RoleName"),
+            reconcile_policy_tags(iam_client, shards[index]['arn'], tags)
+        except ClientError as e:
+            eh.add_log("Error Setting Shard Tags", {"arn": shards[index]['arn'], "error": str(e)}, True)
+            eh.retry_error(str(e), 82)
+            return 0
+        pending.remove(index)
+    eh.add_log("Shard Tags Set", {"tags": tags})
+
+def reconcile_policy_tags(iam_client, policy_arn, tags):
+    current_tags = unformat_tags(iam_client.get_policy(PolicyArn=policy_arn)['Policy'].get("Tags") or [])
+    add_tags, remove_tags = diff_tags(current_tags, tags)
+    delete_tags(lambda batch: iam_client.untag_policy(PolicyArn=policy_arn, TagKeys=batch), remove_tags)
+    write_tags(lambda batch: iam_client.tag_policy(PolicyArn=policy_arn, Tags=batch), add_tags)
+
+def gen_tags_hash(tags):
+    return hashlib.sha256(json.dumps(tags, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def plan_shards(prev_state, shards, tags):
+    """Queues writes for only the shards whose contents changed, tag updates 
+    for the other existing shards when the tags changed, and deletes for 
+    shards that are no longer needed"""
+    props = (prev_state or {}).get("props") or {}
+    old_shard_arns = props.get("shard_arns") or []
+    old_hashes = dict(zip(old_shard_arns, props.get("shard_hashes") or []))
+
+    changed = [i for i, shard in enumerate(shards) if i and old_hashes.get(shard['arn']) != shard['hash']]
+    if changed:
+        eh.add_op("sync_shards", changed)
+
+    # Changed shards have their tags set by sync_shards, the first shard by get_policy
+    if props.get("shard_tags_hash") != gen_tags_hash(tags):
+        retag = [i for i, shard in enumerate(shards) if i and i not in changed and shard['arn'] in old_hashes]
+        if retag:
+            eh.add_op("sync_shard_tags", retag)
+
+    shard_arns = [shard['arn'] for shard in shards]
+    stale = [arn for arn in old_shard_arns[1:] if arn not in shard_arns]
+    if stale:
+        eh.add_op("remove_shards", {arn: {"arn": arn} for arn in stale})
+
+def teardown_policy(iam_client, op_info):
+    """Detaches and deletes the policy in op_info['arn'], returning True once it is gone.
+    Checkpoints into op_info as it goes, so a retried 
+    invocation picks up where the last one stopped"""
+    policy_arn = op_info['arn']
+    if out_of_time():
+        eh.continue_later(40)
+        return False
+    if not op_info.get("exists"):
+        try:
+            iam_client.get_policy(
                 PolicyArn = policy_arn
             )
-            eh.add_log("Detaching From Role", response)
+            op_info['exists'] = True
 
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchEntityException':
-                pass
-            # elif e.response['Error']['Code'] == 'ServiceFailureException':
-            #     return "something that says call me again"
+            if e.response['Error']['Code'] == 'NoSuchEntity':
+                eh.add_log("Old Policy Doesn't Exist", {"policy_arn": policy_arn})
+                return True
             else:
                 raise e
 
-    response = iam_client.list_policy_versions(
-        PolicyArn = policy_arn,
-        MaxItems = 10
-    )
-
-    versions = response.get("Versions")
-
-    if versions:
-        for version in versions:
-            if not version.get("IsDefaultVersion"):
+    if not op_info.get("entities_detached"):
+        while True:
+            if out_of_time():
+                eh.continue_later(40)
+                return False
+            entities, next_marker = list_policy_entity_page(iam_client, policy_arn, op_info.get("marker"))
+            detached = op_info.setdefault("detached", [])
+            entities = [e for e in entities if entity_key(e) not in detached]
+            if not entities:
+                # Everything on this page was detached already, and only still listed until IAM catches up
+                if not next_marker:
+                    break
+                op_info['marker'] = next_marker
+                continue
+
+            results = run_concurrently(
+                lambda entity: detach_policy_from_entity(iam_client, policy_arn, entity),
+                entities, max_workers=DETACH_CONCURRENCY
+            )
+            detached.extend(entity_key(entity) for entity, _, error in results if not error)
+            failed = {entity_key(entity): str(error) for entity, _, error in results if error and not isinstance(error, DeadlineReached)}
+            eh.add_log("Detached Policy From Entities", {"detached": detached, "failed": failed}, bool(failed))
+            if failed:
+                eh.retry_error(summary_error(f"Failed to detach {len(failed)} entities from policy", [error for _, _, error in results]), 40)
+                return False
+            elif deferred_items(results):
+                # The marker still points at this page, and detached holds its progress
+                eh.continue_later(40)
+                return False
+
+            # Detached entities drop out of the listing, so what is left starts at the front again.
+            # Only this page is remembered, in case IAM still lists it for a moment
+            op_info['marker'] = None
+            op_info['detached'] = [entity_key(entity) for entity in entities]
+
+        op_info['entities_detached'] = True
+
+    if op_info.get("versions") is None:
+        op_info['versions'] = list_policy_version_slots(iam_client, policy_arn)
+
+    for version in list(op_info['versions']):
+        if out_of_time():
+            eh.continue_later(50)
+            return False
+        if not version['default']:
+            try:
                 iam_client.delete_policy_version(
                     PolicyArn = policy_arn,
-                    VersionId = version['VersionId']
+                    VersionId = version['id']
                 )
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchEntity':
+                    raise e
+            op_info['versions'].remove(version)
 
-    response = iam_client.delete_policy(
-        PolicyArn = policy_arn
-    )
-
-    eh.add_log("Deleted Policy", response)
-
-    # eh.complete_op("remove_policy")
-    # if complete:
-    #     eh.declare_return(200, 100, success=True)
-
-def get_all_entities_for_policy(policy_arn):
-    iam_client = boto3.client("iam")
-
-    marker = 'marker'
-    policy_groups = []
-    policy_users = []
-    policy_roles = []
-    while marker:
-        params = remove_none_attributes({
-            "PolicyArn": policy_arn,
-            "MaxItems": 100,
-            "Marker": marker if marker != "marker" else None
-        })
-
-        response = iam_client.list_entities_for_policy(**params)
+    try:
+        iam_client.delete_policy(
+            PolicyArn = policy_arn
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'DeleteConflict':
+            # Something was attached or versioned after we looked, start the listing over
+            op_info.update({"marker": None, "detached": [], "entities_detached": False, "versions": None})
+            eh.add_log("Policy Still In Use", {"policy_arn": policy_arn, "error": str(e)}, True)
+            eh.retry_error(str(e), 60)
+            return False
+        elif e.response['Error']['Code'] == 'NoSuchEntity':
+            return True
+        else:
+            raise e
 
-        policy_groups.extend(response.get("PolicyGroups", []))
-        policy_users.extend(response.get("PolicyUsers", []))
-        policy_roles.extend(response.get("PolicyRoles", []))
+    eh.add_log("Deleted Policy", {"policy_arn": policy_arn})
+    return True
 
-        marker = response.get("Marker")
+def entity_key(entity):
+    return f"{entity[0]}/{entity[1]}"
 
-    return policy_groups, policy_users, policy_roles
+def detach_policy_from_entity(iam_client, policy_arn, entity):
+    kind, name = entity
+    try:
+        if kind == "group":
+            iam_client.detach_group_policy(GroupName=name, PolicyArn=policy_arn)
+        elif kind == "user":
+            iam_client.detach_user_policy(UserName=name, PolicyArn=policy_arn)
+        else:
+            iam_client.detach_role_policy(RoleName=name, PolicyArn=policy_arn)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchEntity', 'NoSuchEntityException']:
+            raise e
 
-    
+def list_policy_entity_page(iam_client, policy_arn, marker=None):
+    """Returns the (kind, name) entities on one page of those attached 
+    to a policy, along with the marker for the page after it"""
+    response = iam_client.list_entities_for_policy(**remove_none_attributes({"PolicyArn": policy_arn, "Marker": marker, "MaxItems": 100}))
+    entities = [("group", g.get("GroupName")) for g in response.get("PolicyGroups", [])] + \
+        [("user", u.get("UserName")) for u in response.get("PolicyUsers", [])] + \
+        [("role", r.get("RoleName")) for r in response.get("PolicyRoles", [])]
 
+    return entities, response.get("Marker") if response.get("IsTruncated") else None
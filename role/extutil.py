@@ -2,16 +2,19 @@ import time
 import json
 import datetime
 import re
-import base64
 import hashlib
-import uuid
 import os
+import sys
 import boto3
 import botocore
-import zipfile
-import fastjsonschema
+import botocore.config
+import threading
+import contextvars
 
-from urllib.parse import quote
+# base64, uuid, zipfile and fastjsonschema are imported where they are used. 
+# Most invocations never reach those paths, and their imports add to every cold start
+
+from urllib.parse import quote, unquote
 
 NAME_REGEX = r"^[a-zA-Z0-9\-\_]+$"
 LOWERCASE_NAME_REGEX = r"^[a-z0-9\-\_]+$"
@@ -19,6 +22,7 @@ NO_UNDERSCORE_NAME_REGEX = r"^[a-zA-Z0-9\-]+$"
 NO_UNDERSCORE_LOWERCASE_NAME_REGEX = r"^[a-z0-9\-]+$"
 
 def safe_encode(string):
+    import base64
     return base64.b32encode(string.encode("ascii")).decode("ascii").replace("=", "8")
 
 def safeval(string, no_underscores, no_uppercase):
@@ -87,6 +91,7 @@ def remove_none_attributes(payload):
     return {k: v for k, v in payload.items() if not v is None}
 
 def random_id():
+    import uuid
     return str(uuid.uuid4())
 
 def current_epoch_time_usec_num():
@@ -99,6 +104,7 @@ def lambda_env(key):
         raise e
 
 def create_zip(file_name, path):
+    import zipfile
     ziph=zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED)
     # ziph is zipfile handle
     for root, dirs, files in os.walk(path):
@@ -108,6 +114,187 @@ def create_zip(file_name, path):
                                        os.path.join(path, '')))
     ziph.close()
 
+CLIENT_MAX_POOL_CONNECTIONS = 50
+CLIENT_MAX_ATTEMPTS = 5
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Calls per second and burst for each service's read and write bucket. 
+# Override with CK_<SERVICE>_READ_RATE and CK_<SERVICE>_WRITE_RATE
+RATE_LIMITS = {
+    "iam": {"read": 20, "write": 10}
+}
+READ_OPERATION_PREFIXES = ("Get", "List")
+
+class TokenBucket:
+    """Hands out rate tokens per second, up to burst at once. acquire blocks until its 
+    token is due and returns the seconds it waited. If that wait would run into the 
+    deadline margin it raises DeadlineReached instead, and the call is never made"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.acquired = 0
+        self.waits = 0
+        self.waited_sec = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now and sleep outside the lock until it is due
+            self.tokens -= 1
+            wait_sec = -self.tokens / self.rate if self.tokens < 0 else 0
+            time_left = sec_before_margin() if wait_sec else None
+            if time_left is not None and wait_sec >= time_left:
+                self.tokens += 1
+                raise DeadlineReached()
+            self.acquired += 1
+            if wait_sec:
+                self.waits += 1
+                self.waited_sec += wait_sec
+        if wait_sec:
+            time.sleep(wait_sec)
+        return wait_sec
+
+    def metrics(self):
+        return {"acquired": self.acquired, "waits": self.waits, "waited_sec": round(self.waited_sec, 3)}
+
+_rate_limiters = {}
+
+def rate_limiter(service_name):
+    """The container's read and write buckets for a service, or None if it is not rate limited"""
+    if service_name not in RATE_LIMITS:
+        return None
+    if service_name not in _rate_limiters:
+        _rate_limiters[service_name] = {
+            kind: TokenBucket(float(lambda_env(f"CK_{service_name.upper()}_{kind.upper()}_RATE") or rate))
+            for kind, rate in RATE_LIMITS[service_name].items()
+        }
+    return _rate_limiters[service_name]
+
+def rate_limiter_metrics():
+    """Calls, waits and seconds spent waiting per bucket since the container started"""
+    return {
+        service_name: {kind: bucket.metrics() for kind, bucket in buckets.items()}
+        for service_name, buckets in _rate_limiters.items()
+    }
+
+def register_rate_limiter(client, service_name):
+    buckets = rate_limiter(service_name)
+    if not buckets:
+        return None
+
+    def wait_for_token(model, **kwargs):
+        buckets["read" if model.name.startswith(READ_OPERATION_PREFIXES) else "write"].acquire()
+
+    client.meta.events.register(f"before-parameter-build.{service_name}", wait_for_token)
+
+def get_client(service_name):
+    """Returns the container's one client for a service, creating it on first use.
+    Clients are thread safe, so concurrent ops and batch components share its 
+    connection pool. Pool size and retry attempts can be set with the 
+    CK_MAX_POOL_CONNECTIONS and CK_MAX_ATTEMPTS environment variables. 
+    Calls to services in RATE_LIMITS wait on the container's token buckets"""
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = boto3.session.Session().client(service_name, config=botocore.config.Config(
+                    max_pool_connections=int(lambda_env("CK_MAX_POOL_CONNECTIONS") or CLIENT_MAX_POOL_CONNECTIONS),
+                    tcp_keepalive=True,
+                    retries={
+                        "mode": "adaptive",
+                        "max_attempts": int(lambda_env("CK_MAX_ATTEMPTS") or CLIENT_MAX_ATTEMPTS)
+                    }
+                ))
+                register_rate_limiter(client, service_name)
+                _clients[service_name] = client
+    return client
+
+INVOKE_EXTENSION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "arn": {"type": "string"},
+        "component_def": {"type": "object"},
+        "child_key": {"type": "string"},
+        "progress_start": {"type": "number"},
+        "progress_end": {"type": "number"},
+        "object_name": {"type": ["string", "null"]},
+        "op": {"type": ["string", "null"]},
+        "merge_props": {"type": ["boolean", "null"]},
+        "links_prefix": {"type": ["string", "null"]},
+        "ignore_props_links": {"type": ["boolean", "null"]},
+        "synchronous": {"type": ["boolean", "null"]}
+    },
+    "required": ["arn", "component_def", "child_key", "progress_start", "progress_end"]
+}
+
+_validators = {}
+
+def compiled_validator(key, schema_func):
+    """Compiles the schema returned by schema_func the first time key is asked for, 
+    and reuses it for the rest of the container's life. Returns None if there is no schema"""
+    if key not in _validators:
+        import fastjsonschema
+        schema = schema_func()
+        # use_default=False, so validating never fills defaults into the caller's data
+        _validators[key] = fastjsonschema.compile(schema, use_default=False) if schema else None
+    return _validators[key]
+
+# Combinators the handlers relax with their own defaults, so they are left to CK. 
+# The role schema's anyOf requires policies or policy_arns, which the handler defaults to []
+LOCAL_SCHEMA_SKIPPED_KEYS = ["anyOf"]
+
+def find_kommand_json():
+    """kommand.json sits at the root of the extension, one level above each handler. 
+    KOMMAND_JSON_PATH overrides where it is looked for"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path in [lambda_env("KOMMAND_JSON_PATH"), os.path.join(here, "kommand.json"), os.path.join(os.path.dirname(here), "kommand.json")]:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+def component_input_schema(component_type):
+    """The input schema for component_type. Each handler directory is deployed on its own, 
+    so it ships input_schema.json, a copy of its component's input from kommand.json. 
+    kommand.json is used when KOMMAND_JSON_PATH is set or the copy is missing"""
+    bundled = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input_schema.json")
+    path = find_kommand_json() if lambda_env("KOMMAND_JSON_PATH") or not os.path.isfile(bundled) else None
+    if path:
+        with open(path) as f:
+            schema = json.load(f)["components"][component_type].get("input")
+    elif os.path.isfile(bundled):
+        with open(bundled) as f:
+            schema = json.load(f)
+    else:
+        log("WARNING", "No input schema found, inputs will not be validated", component_type=component_type)
+        return None
+    return schema and {k: v for k, v in schema.items() if k not in LOCAL_SCHEMA_SKIPPED_KEYS}
+
+def component_def_validator(component_type):
+    return compiled_validator(component_type, lambda: component_input_schema(component_type))
+
+def component_def_error(component_type, component_def):
+    """Validates component_def against the input schema kommand.json 
+    declares for component_type. Returns the error message, or None if valid"""
+    import fastjsonschema
+    validator = component_def_validator(component_type)
+    if not validator:
+        return None
+    try:
+        validator(component_def)
+    except fastjsonschema.JsonSchemaValueException as e:
+        # Not every message names the field it failed on
+        return e.message if e.message.startswith(e.name) else f"{e.name}: {e.message}"
+    return None
+
 def account_context(context):
     vals = context.invoked_function_arn.split(':')
     return {
@@ -115,6 +302,30 @@ def account_context(context):
         "region": vals[3]
     }
 
+LOG_STRING_MAX_CHARS = 256
+LOG_LIST_MAX_ITEMS = 20
+LOG_MAX_BYTES = 32768
+
+def summarize_response(response, keys=None):
+    """Cuts a boto3 response down to what is worth keeping in a log. ResponseMetadata 
+    is dropped, datetimes become strings, and long strings and lists are shortened. 
+    If keys is passed, only those top level fields are kept"""
+    if isinstance(response, dict):
+        return {
+            k: summarize_response(v) for k, v in response.items() 
+            if k != "ResponseMetadata" and (keys is None or k in keys)
+        }
+    elif isinstance(response, (list, tuple)):
+        summary = [summarize_response(v) for v in response[:LOG_LIST_MAX_ITEMS]]
+        if len(response) > LOG_LIST_MAX_ITEMS:
+            summary.append(f"... {len(response) - LOG_LIST_MAX_ITEMS} more")
+        return summary
+    elif isinstance(response, datetime.datetime):
+        return str(response)
+    elif isinstance(response, str) and len(response) > LOG_STRING_MAX_CHARS:
+        return f"{response[:LOG_STRING_MAX_CHARS]}..."
+    return response
+
 def gen_log(title, details, is_error=False, link=None):
     return {
         "title": title,
@@ -128,6 +339,72 @@ def defaultconverter(o):
     if isinstance(o, datetime.datetime):
         return o.__str__()
 
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+LOG_BUFFER_MAX_RECORDS = 500
+
+class LogWriter:
+    """Buffers json lines log records and writes them to stdout in one go on flush.
+    A WARNING or ERROR flushes the buffer straight away, so the lines explaining a 
+    timeout or crash before finish are not lost with it. CK_LOG_LEVEL (default INFO) drops records below that level before anything is 
+    formatted. CK_LOG_SAMPLE_RATE (default 1) keeps records below WARNING for only 
+    that fraction of invocations, decided once per event in sample()"""
+
+    def __init__(self):
+        self.level = LOG_LEVELS.get((lambda_env("CK_LOG_LEVEL") or "INFO").upper(), LOG_LEVELS["INFO"])
+        self.sample_rate = float(lambda_env("CK_LOG_SAMPLE_RATE") or 1)
+        self._sampled = contextvars.ContextVar("log_sampled", default=True)
+        self._records = []
+        self._lock = threading.Lock()
+
+    def sample(self):
+        if self.sample_rate < 1:
+            import random
+            self._sampled.set(random.random() < self.sample_rate)
+
+    def enabled(self, level):
+        levelno = LOG_LEVELS[level]
+        return levelno >= self.level and (levelno >= LOG_LEVELS["WARNING"] or self._sampled.get())
+
+    def log(self, level, message, **fields):
+        """Returns the serialized record, or None if it was filtered out"""
+        if not self.enabled(level):
+            return None
+        # Formatted now, so later changes to the objects logged don't leak into the record
+        record = json.dumps({"level": level, "message": message, **fields}, default=defaultconverter)
+        with self._lock:
+            self._records.append(record)
+            if len(self._records) < LOG_BUFFER_MAX_RECORDS and LOG_LEVELS[level] < LOG_LEVELS["WARNING"]:
+                return record
+            records, self._records = self._records, []
+        self._write(records)
+        return record
+
+    def flush(self):
+        with self._lock:
+            records, self._records = self._records, []
+        self._write(records)
+
+    def _write(self, records):
+        if records:
+            sys.stdout.write("\n".join(records) + "\n")
+            sys.stdout.flush()
+
+logger = LogWriter()
+
+def log(level, message, **fields):
+    return logger.log(level, message, **fields)
+
+RESPONSE_PRINT_MAX_CHARS = 10000
+
+def print_response(serialized):
+    """Logs the serialized response and its size, capped at CK_RESPONSE_PRINT_MAX_CHARS 
+    characters. Set CK_PRINT_RESPONSE to false to skip it entirely"""
+    if (lambda_env("CK_PRINT_RESPONSE") or "true").lower() == "false" or not logger.enabled("INFO"):
+        return None
+    max_chars = int(lambda_env("CK_RESPONSE_PRINT_MAX_CHARS") or RESPONSE_PRINT_MAX_CHARS)
+    log("INFO", "Response", response_bytes=len(serialized.encode()), 
+        response=f"{serialized[:max_chars]}{'...' if len(serialized) > max_chars else ''}")
+
 def creturn(status_code, progress, success=None, error=None, logs=None, pass_back_data=None, state=None, props=None, links=None, callback_sec=2, error_details={}):
     
     assembled = remove_none_attributes({
@@ -143,20 +420,452 @@ def creturn(status_code, progress, success=None, error=None, logs=None, pass_bac
         "logs": logs,
         "callback_sec":callback_sec
     })
-    print(f'assembled = {assembled}')
+    # One serialization serves the print, the size measurement and the returned copy
+    serialized = json.dumps(assembled, default=defaultconverter)
+    print_response(serialized)
+
+    return json.loads(serialized)
+
+PASS_BACK_DATA_ENCODING = 2
+PASS_BACK_DATA_COMPRESS_BYTES = 4096
+PASS_BACK_DATA_MAX_BYTES = 65536
+ARN_PREFIX_REGEX = re.compile(r"^arn:[^:]+:[^:]*:[^:]*:[^:]*:")
+
+def intern_arn_prefixes(o, prefixes):
+    """Replaces the arn:partition:service:region:account: prefix of every string with 
+    @<index>| into prefixes. Strings already starting with @ get a second one"""
+    if isinstance(o, str):
+        match = ARN_PREFIX_REGEX.match(o)
+        if match:
+            index = prefixes.setdefault(match.group(0), len(prefixes))
+            return f"@{index}|{o[match.end():]}"
+        return f"@{o}" if o.startswith("@") else o
+    elif isinstance(o, dict):
+        return {intern_arn_prefixes(k, prefixes): intern_arn_prefixes(v, prefixes) for k, v in o.items()}
+    elif isinstance(o, (list, tuple)):
+        return [intern_arn_prefixes(v, prefixes) for v in o]
+    return o
+
+def expand_arn_prefixes(o, prefixes):
+    if isinstance(o, str):
+        if o.startswith("@@"):
+            return o[1:]
+        elif o.startswith("@"):
+            index, rest = o[1:].split("|", 1)
+            return f"{prefixes[int(index)]}{rest}"
+        return o
+    elif isinstance(o, dict):
+        return {expand_arn_prefixes(k, prefixes): expand_arn_prefixes(v, prefixes) for k, v in o.items()}
+    elif isinstance(o, list):
+        return [expand_arn_prefixes(v, prefixes) for v in o]
+    return o
+
+def encode_pass_back_data(pass_back_data):
+    """Packs handler state for the trip through CK. Empty fields are dropped and ARN 
+    prefixes interned. Past CK_PASS_BACK_DATA_COMPRESS_BYTES the body is zlib compressed. 
+    last_retry stays readable at the top level for parent extensions.
+    Returns the encoded pass_back_data and its size in bytes"""
+    body = {k: v for k, v in pass_back_data.items() if k != "last_retry" and v not in (None, {}, [])}
+    prefixes = {}
+    interned = intern_arn_prefixes(body, prefixes)
+    payload = {"prefixes": list(prefixes), "data": interned}
+    serialized = json.dumps(payload, separators=(",", ":"), default=defaultconverter)
+    encoded = remove_none_attributes({
+        "encoding": PASS_BACK_DATA_ENCODING,
+        "last_retry": pass_back_data.get("last_retry")
+    })
+    if len(serialized) > int(lambda_env("CK_PASS_BACK_DATA_COMPRESS_BYTES") or PASS_BACK_DATA_COMPRESS_BYTES):
+        import base64, zlib
+        encoded["zdata"] = base64.b64encode(zlib.compress(serialized.encode())).decode()
+        return encoded, len(encoded["zdata"])
+    encoded.update(payload)
+    return encoded, len(serialized)
 
-    return json.loads(json.dumps(assembled, default=defaultconverter))
+def decode_pass_back_data(pass_back_data):
+    """Inverse of encode_pass_back_data. Anything not in that encoding is returned as is"""
+    if pass_back_data.get("encoding") != PASS_BACK_DATA_ENCODING:
+        return pass_back_data
+    if pass_back_data.get("zdata"):
+        import base64, zlib
+        payload = json.loads(zlib.decompress(base64.b64decode(pass_back_data["zdata"])))
+    else:
+        payload = pass_back_data
+    decoded = expand_arn_prefixes(payload["data"], payload["prefixes"])
+    if pass_back_data.get("last_retry"):
+        decoded["last_retry"] = pass_back_data["last_retry"]
+    return decoded
 
 def handle_common_errors(error, extension_handler, text, progress, perm_errors=[]):
     if error.response['Error']['Code'] in perm_errors:
         extension_handler.add_log(f"{text}: {error.response['Error']['Code']}", {"error": str(error)}, True)
         extension_handler.perm_error(f"{text}: {str(error)}", progress)
-        print(f"Permanent Error: {text}: {str(error)}")
+        log("ERROR", "Permanent Error", text=text, error=str(error))
     else:
         extension_handler.add_log(f"{text}: {error.response['Error']['Code']}", {"error": str(error)}, True)
         extension_handler.retry_error(f"{text}: {str(error)}", progress)
-        print(f"Retry Error: {text}: {str(error)}")
+        log("WARNING", "Retry Error", text=text, error=str(error))
+
+
+POLICY_LIST_KEYS = ["Action", "NotAction", "Resource", "NotResource"]
+POLICY_PRINCIPAL_KEYS = ["Principal", "NotPrincipal"]
+
+def canonical_policy_values(value):
+    """IAM treats "x" and ["x"] the same, and does not care about order or duplicates"""
+    if isinstance(value, str):
+        return [value]
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    values = set(value) if all(isinstance(v, str) for v in value) else set(
+        ("true" if v else "false") if isinstance(v, bool) else str(v)
+        for v in value
+    )
+    return sorted(values)
+
+def normalize_policy_statement(statement):
+    normalized = {}
+    for key, value in statement.items():
+        if key in POLICY_LIST_KEYS:
+            normalized[key] = canonical_policy_values(value)
+        elif key in POLICY_PRINCIPAL_KEYS and isinstance(value, dict):
+            normalized[key] = {k: canonical_policy_values(v) for k, v in value.items()}
+        elif key == "Condition" and isinstance(value, dict):
+            normalized[key] = {
+                operator: {k: canonical_policy_values(v) for k, v in (conditions or {}).items()}
+                for operator, conditions in value.items()
+            }
+        else:
+            normalized[key] = value
+    return normalized
+
+def policy_statement_key(statement):
+    return json.dumps(statement, sort_keys=True, separators=(",", ":"))
+
+def keyed_policy_statements(document):
+    """Splits a policy document into its top level fields 
+    and a dict of normalized statements keyed by their canonical JSON"""
+    if isinstance(document, str):
+        # IAM returns documents URL encoded if botocore has not already decoded them
+        document = json.loads(document if document.lstrip().startswith("{") else unquote(document))
+    statements = document.get("Statement") or []
+    if isinstance(statements, dict):
+        statements = [statements]
+
+    keyed_statements = {}
+    for statement in statements:
+        normalized = normalize_policy_statement(statement)
+        keyed_statements[policy_statement_key(normalized)] = normalized
+
+    return {k: v for k, v in document.items() if k != "Statement"}, keyed_statements
+
+def normalize_policy_document(document):
+    """Returns a canonical copy of an IAM policy document. 
+    Two documents that IAM evaluates the same way normalize to the same value"""
+    fields, keyed_statements = keyed_policy_statements(document)
+    fields["Statement"] = [keyed_statements[k] for k in sorted(keyed_statements)]
+    return fields
+
+def diff_policy_documents(current, desired):
+    """Returns an empty dict if the documents are equivalent, otherwise 
+    the statements added/removed and the top level fields that changed"""
+    current_fields, current_statements = keyed_policy_statements(current or {})
+    desired_fields, desired_statements = keyed_policy_statements(desired or {})
+
+    return {k: v for k, v in {
+        "added_statements": [s for k, s in desired_statements.items() if k not in current_statements],
+        "removed_statements": [s for k, s in current_statements.items() if k not in desired_statements],
+        "changed_fields": sorted(
+            k for k in set(current_fields.keys()) | set(desired_fields.keys()) 
+            if current_fields.get(k) != desired_fields.get(k)
+        )
+    }.items() if v}
+
+POLICY_VERSIONS = ["2012-10-17", "2008-10-17"]
+POLICY_DOCUMENT_KEYS = ["Version", "Id", "Statement"]
+POLICY_STATEMENT_KEYS = ["Sid", "Effect", "Principal", "NotPrincipal", "Action", "NotAction", "Resource", "NotResource", "Condition"]
+POLICY_ACTION_REGEX = r"^(\*|[a-zA-Z0-9\-]+:[a-zA-Z0-9\*\?]+)$"
+POLICY_SID_REGEX = r"^[a-zA-Z0-9]*$"
+MAX_MANAGED_POLICY_CHARS = 6144
+MAX_TRUST_POLICY_CHARS = 2048
+
+def compact_json(document):
+    return json.dumps(document, separators=(",", ":"))
+
+def policy_document_size(document):
+    """The size IAM measures a policy against, which does not count whitespace"""
+    serialized = compact_json(document)
+    return len(serialized) - sum(map(serialized.count, " \t\n\r"))
+
+def policy_statement_errors(statement, label, trust_policy=False):
+    if not isinstance(statement, dict):
+        return [f"{label} must be an object"]
 
+    errors = [f"{label} has unknown key {k}" for k in statement.keys() if k not in POLICY_STATEMENT_KEYS]
+    if statement.get("Effect") not in ["Allow", "Deny"]:
+        errors.append(f"{label} Effect must be Allow or Deny, got {statement.get('Effect')}")
+    if not re.match(POLICY_SID_REGEX, str(statement.get("Sid", ""))):
+        errors.append(f"{label} Sid must be alphanumeric")
+
+    for first, second, required in [
+        ("Action", "NotAction", True), 
+        ("Resource", "NotResource", not trust_policy),
+        ("Principal", "NotPrincipal", trust_policy)
+    ]:
+        present = [k for k in [first, second] if k in statement]
+        if len(present) > 1:
+            errors.append(f"{label} cannot have both {first} and {second}")
+        elif required and not present:
+            errors.append(f"{label} must have {first} or {second}")
+        elif not required and present and first == "Principal":
+            errors.append(f"{label} cannot have {present[0]} in an identity policy")
+
+    for key in ["Action", "NotAction", "Resource", "NotResource"]:
+        if key not in statement:
+            continue
+        values = statement[key] if isinstance(statement[key], list) else [statement[key]]
+        if not values or not all(isinstance(v, str) and v for v in values):
+            errors.append(f"{label} {key} must be a non-empty string or list of non-empty strings")
+        elif key in ["Action", "NotAction"]:
+            errors.extend(f"{label} {key} {v} is not of the form service:action" for v in values if not re.match(POLICY_ACTION_REGEX, v))
+
+    if "Condition" in statement and not isinstance(statement["Condition"], dict):
+        errors.append(f"{label} Condition must be an object")
+    return errors
+
+def policy_document_errors(document, trust_policy=False, max_chars=None):
+    """Checks a policy document locally, so that bad input fails 
+    before the round trip to IAM. Returns a list of problems, empty if none"""
+    if not isinstance(document, dict):
+        return ["Policy document must be an object"]
+
+    errors = [f"Policy document has unknown key {k}" for k in document.keys() if k not in POLICY_DOCUMENT_KEYS]
+    if "Version" in document and document["Version"] not in POLICY_VERSIONS:
+        errors.append(f"Version must be one of {POLICY_VERSIONS}, got {document['Version']}")
+
+    statements = document.get("Statement")
+    if isinstance(statements, dict):
+        statements = [statements]
+    if not statements or not isinstance(statements, list):
+        return errors + ["Statement must be an object or a non-empty list"]
+
+    for i, statement in enumerate(statements):
+        errors.extend(policy_statement_errors(statement, f"Statement {i}", trust_policy))
+
+    sids = [s.get("Sid") for s in statements if isinstance(s, dict) and s.get("Sid")]
+    errors.extend(f"Sid {sid} is used more than once" for sid in sorted(set(sids)) if sids.count(sid) > 1)
+
+    if max_chars and not errors:
+        size = policy_document_size(document)
+        if size > max_chars:
+            errors.append(f"Policy document is {size} characters, over the limit of {max_chars}")
+    return errors
+
+def paginate_pages(method, marker=None, **params):
+    """Lazily yields each response of an IAM list call that uses Marker/IsTruncated. 
+    Stopping iteration early means the remaining pages are never fetched"""
+    while True:
+        response = method(**remove_none_attributes({**params, "Marker": marker}))
+        yield response
+        if not response.get("IsTruncated"):
+            return
+        marker = response.get("Marker")
+
+def paginate(method, result_key, **params):
+    """Lazily yields the items under result_key across every page of an IAM list call"""
+    for response in paginate_pages(method, **params):
+        yield from response.get(result_key) or []
+
+MAX_TAGS_PER_CALL = 50
+
+def diff_tags(current, desired):
+    """Returns the tags that are new or have a new value, and the keys that are no longer wanted"""
+    upsert_tags = {k: v for k, v in desired.items() if k not in current or current[k] != v}
+    remove_keys = sorted(k for k in current.keys() if k not in desired)
+    return upsert_tags, remove_keys
+
+def chunk_list(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def write_tags(tag_func, tags):
+    """Calls tag_func with as few batches of {"Key", "Value"} tags as IAM allows.
+    Each batch is removed from tags once written, so a retry only sends what is left"""
+    for keys in chunk_list(sorted(tags.keys()), MAX_TAGS_PER_CALL):
+        tag_func([{"Key": k, "Value": tags[k]} for k in keys])
+        for k in keys:
+            del tags[k]
+
+def delete_tags(untag_func, keys):
+    """Calls untag_func with as few batches of keys as IAM allows.
+    Each batch is removed from keys once deleted, so a retry only sends what is left"""
+    for batch in chunk_list(list(keys), MAX_TAGS_PER_CALL):
+        untag_func(batch)
+        for k in batch:
+            keys.remove(k)
+
+THROTTLING_ERROR_CODES = ["Throttling", "ThrottlingException", "RequestLimitExceeded", "TooManyRequestsException"]
+
+def is_throttling_error(error):
+    return isinstance(error, botocore.exceptions.ClientError) and \
+        error.response['Error']['Code'] in THROTTLING_ERROR_CODES
+
+EVENTUAL_CONSISTENCY_ERROR_CODES = ["NoSuchEntity", "ConcurrentModification", "EntityTemporarilyUnmodifiable"]
+CLIENT_ERROR_REGEX = re.compile(r"An error occurred \((?P<code>[^)]+)\) when calling the (?P<operation>\w+) operation")
+SUMMARY_ERROR_REGEX = re.compile(r"^(?P<code>\w+): ")
+RETRY_POLICIES = {
+    "throttling": {"base_sec": 2, "cap_sec": 120, "max_retries": 10},
+    "eventual_consistency": {"base_sec": 1, "cap_sec": 20, "max_retries": 8},
+    # max_retries None falls back to the handler's max_retries_per_error_code
+    "default": {"base_sec": 2, "cap_sec": 300, "max_retries": None}
+}
+RETRY_BUDGET = 30
+
+def retry_key(error):
+    """The key retries of error are counted under. ClientError text becomes code:operation, 
+    anything else has its ARNs and numbers blanked out, so one failure is one key"""
+    match = CLIENT_ERROR_REGEX.search(error)
+    if match:
+        return f"{match.group('code')}:{match.group('operation')}"
+    return re.sub(r"\d+", "N", re.sub(r"arn:[^\s'\",]+", "ARN", error))
+
+def summary_error(message, errors):
+    """Prefixes the summary of a fan-out failure with the most common ClientError 
+    code among errors, so its retries are scheduled for what actually went wrong"""
+    codes = [e.response['Error']['Code'] for e in errors if isinstance(e, botocore.exceptions.ClientError)]
+    return f"{max(set(codes), key=codes.count)}: {message}" if codes else message
+
+def retry_class(error):
+    match = CLIENT_ERROR_REGEX.search(error) or SUMMARY_ERROR_REGEX.match(error)
+    code = match.group("code") if match else None
+    if code in THROTTLING_ERROR_CODES or "Rate exceeded" in error:
+        return "throttling"
+    elif code in EVENTUAL_CONSISTENCY_ERROR_CODES:
+        return "eventual_consistency"
+    return "default"
+
+def decorrelated_jitter(base_sec, cap_sec, previous_sec):
+    """Next callback delay, random between base_sec and three times the previous delay. 
+    Deploys that failed together drift apart instead of retrying in lockstep"""
+    import random
+    return int(min(cap_sec, random.uniform(base_sec, max(base_sec, previous_sec) * 3))) or 1
+
+DEADLINE_MARGIN_SEC = 10
+# Caps the margin for short timeouts, which would otherwise be out of time from the start
+DEADLINE_MARGIN_FRACTION = 0.2
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+class DeadlineReached(Exception):
+    """Stands in for work that was not started because the invocation was about to time out"""
+
+def set_deadline(context):
+    """Records when the Lambda behind context times out, and the margin to keep before it, 
+    for the current event. The margin is CK_DEADLINE_MARGIN_SEC, but at most 
+    DEADLINE_MARGIN_FRACTION of the time the event started with"""
+    get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+    if not get_remaining_time:
+        _deadline.set(None)
+        return None
+    remaining = get_remaining_time() / 1000
+    margin = min(float(lambda_env("CK_DEADLINE_MARGIN_SEC") or DEADLINE_MARGIN_SEC), remaining * DEADLINE_MARGIN_FRACTION)
+    _deadline.set((time.monotonic() + remaining, margin))
+
+def remaining_sec():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline[0] - time.monotonic()
+
+def sec_before_margin():
+    """Seconds until out_of_time() turns true, or None if there is no deadline"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline[0] - time.monotonic() - deadline[1]
+
+def out_of_time():
+    """True once less than the margin is left before the timeout. New work 
+    should not be started then, but checkpointed for an immediate callback"""
+    time_left = sec_before_margin()
+    return time_left is not None and time_left < 0
+
+def deferred_items(results):
+    """The items run_concurrently did not start because the deadline was near"""
+    return [item for item, _, error in results if isinstance(error, DeadlineReached)]
+
+def run_concurrently(func, items, max_workers=8, max_rounds=5, backoff_sec=1):
+    """Calls func on every item using at most max_workers threads.
+    Throttled calls are retried in another round with half the concurrency.
+    Items not started before out_of_time() get a DeadlineReached error instead.
+    Returns a list of (item, result, error) tuples, in the same order as items"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call_before_deadline(item):
+        if out_of_time():
+            raise DeadlineReached()
+        return func(item)
+
+    results = [(item, None, None) for item in items]
+    pending = list(range(len(items)))
+    workers = max(1, max_workers)
+    for round_number in range(max_rounds):
+        if round_number and pending:
+            wait_sec = backoff_sec * 2**(round_number - 1)
+            time_left = sec_before_margin()
+            if time_left is not None and wait_sec >= time_left:
+                # Sleeping would run into the margin, so these are left for the next invocation
+                for i in pending:
+                    results[i] = (items[i], None, DeadlineReached())
+                break
+            time.sleep(wait_sec)
+
+        throttled = []
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as executor:
+            # Run in a copy of the caller's context so func still sees the event's handler
+            futures = [(i, executor.submit(contextvars.copy_context().run, call_before_deadline, items[i])) for i in pending]
+            for i, future in futures:
+                try:
+                    results[i] = (items[i], future.result(), None)
+                except Exception as e:
+                    results[i] = (items[i], None, e)
+                    if is_throttling_error(e):
+                        throttled.append(i)
+
+        pending = throttled
+        if not pending:
+            break
+        workers = max(1, workers // 2)
+
+    return results
+
+BATCH_EVENT_KEYS = ["batch", "max_concurrency"]
+BATCH_CONCURRENCY = 8
+
+def run_batch(handler_func, event, context, max_concurrency=BATCH_CONCURRENCY):
+    """Reconciles many components in one invocation. The event looks like 
+    {"batch": [event, ...], "max_concurrency": n, ...}, where any other top level 
+    keys (project_code, repo_id, op...) are defaults for every component event.
+    Returns each component's result, in order"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    shared = {k: v for k, v in event.items() if k not in BATCH_EVENT_KEYS}
+    component_events = [
+        {**shared, **{k: v for k, v in component.items() if k not in BATCH_EVENT_KEYS}}
+        for component in event.get("batch") or []
+    ]
+
+    # Each component gets its own context, so its handler state stays its own
+    def run_component(component_event):
+        return contextvars.copy_context().run(handler_func, component_event, context)
+
+    max_concurrency = event.get("max_concurrency") or max_concurrency
+    if max_concurrency <= 1 or len(component_events) <= 1:
+        results = [run_component(component_event) for component_event in component_events]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(component_events))) as executor:
+            results = list(executor.map(run_component, component_events))
+
+    return {
+        "statusCode": 200,
+        "results": [
+            {"component_name": component_event.get("component_name"), **result}
+            for component_event, result in zip(component_events, results)
+        ]
+    }
 
 # def sort_f(td):
 #     return td['timestamp_usec']
@@ -165,8 +874,12 @@ class ExtensionHandler:
 
     def refresh(self):
         self.logs = []
+        self.log_bytes = 0
         self.ops = {}
         self.retries = {}
+        self.retry_delays = {}
+        self.continuation = False
+        self.ops_snapshot = None
         self.ret = False
         self.callback_sec = 0
         self.status_code = None
@@ -185,13 +898,16 @@ class ExtensionHandler:
         self.bucket = None
         self.component_name = None
     
-    def __init__(self, ignore_undeclared_return=True, max_retries_per_error_code=6):
+    def __init__(self, ignore_undeclared_return=True, max_retries_per_error_code=6, retry_budget=None):
         self.refresh()
+        self.retry_budget = retry_budget or int(lambda_env("CK_RETRY_BUDGET") or RETRY_BUDGET)
         self.ignore_undelared_return = ignore_undeclared_return
         self.max_retries_per_error_code = max_retries_per_error_code
 
-    def capture_event(self, event):
+    def capture_event(self, event, context=None):
         self.refresh()
+        if context:
+            set_deadline(context)
         if event.get("pass_back_data"):
             self.declare_pass_back_data(event["pass_back_data"])
         self.project_code = event.get("project_code")
@@ -199,44 +915,27 @@ class ExtensionHandler:
         self.bucket = event.get("bucket")
         self.component_name = event.get("component_name")
         self.op = event.get("op")
+        self.ops_snapshot = self.snapshot_ops()
         
     def declare_pass_back_data(self, pass_back_data):
-        pbd = pass_back_data.copy()
+        pbd = decode_pass_back_data(pass_back_data).copy()
+        pbd.pop("last_retry", None)
         self.ops = pbd.pop('ops', {}) or {}
         self.retries = pbd.pop('retries', {}) or {}
+        self.retry_delays = pbd.pop('retry_delays', {}) or {}
         self.props = pbd.pop("props", {}) or {}
         self.links = pbd.pop("links", {}) or {}
         self.state = pbd.pop("state", {}) or {}
-        print(f"Ops = {self.ops}, Retries = {self.retries}, Links = {self.links}, Props = {self.props}")
+        log("DEBUG", "Pass Back Data", ops=self.ops, retries=self.retries, links=self.links, props=self.props, children=pbd)
         self.children = pbd
-        if pbd:
-            print(f"Set Children {self.children}")
 
     def invoke_extension(self, arn, component_def, child_key, 
             progress_start, progress_end, object_name=None, 
             op=None, merge_props=False, links_prefix=None,
             ignore_props_links=False, synchronous=True):
 
-        schema = {
-            "type": "object",
-            "properties": {
-                "arn": {"type": "string"},
-                "component_def": {"type": "object"},
-                "child_key": {"type": "string"},
-                "progress_start": {"type": "number"},
-                "progress_end": {"type": "number"},
-                "object_name": {"type": ["string", "null"]},
-                "op": {"type": ["string", "null"]},
-                "merge_props": {"type": ["boolean", "null"]},
-                "links_prefix": {"type": ["string", "null"]},
-                "ignore_props_links": {"type": ["boolean", "null"]},
-                "synchronous": {"type": ["boolean", "null"]}
-            },
-            "required": ["arn", "component_def", "child_key", "progress_start", "progress_end"]
-        }
-
         try:
-            fastjsonschema.validate(schema, {
+            compiled_validator("invoke_extension", lambda: INVOKE_EXTENSION_SCHEMA)({
                 "arn": arn,
                 "component_def": component_def,
                 "child_key": child_key,
@@ -257,7 +956,7 @@ class ExtensionHandler:
         if child_key in ['ops', 'retries', 'props', 'links']:
             raise Exception(f"Child key cannot be set to {child_key}. Please choose another key")
         
-        l_client = boto3.client("lambda")
+        l_client = get_client("lambda")
         child_key = child_key or arn
         op = op or self.op
         
@@ -286,12 +985,12 @@ class ExtensionHandler:
             )
 
             if response.get("StatusCode") not in [200,202,204]:
-                print(f'Error = {response["Payload"].read()}')
+                log("ERROR", "Invoke Error", child_key=child_key, payload=response["Payload"].read().decode())
                 raise Exception(f'Function Error = {response.get("FunctionError")}')
 
             if synchronous:
                 result = json.loads(response["Payload"].read())
-                print(f"Invoke Result = {result}")
+                log("DEBUG", "Invoke Result", child_key=child_key, result=result)
 
                 logs = result.get("logs") or []
                 progress = result.get("progress") or 0
@@ -348,11 +1047,11 @@ class ExtensionHandler:
 
         
     def add_op(self, opkey, opvalue=True):
-        print(f'add op {opkey} with value {opvalue}')
+        log("DEBUG", "Add Op", op=opkey, value=opvalue)
         self.ops[opkey] = opvalue
         
     def complete_op(self, opkey):
-        print(f'completing op {opkey}')
+        log("DEBUG", "Complete Op", op=opkey)
         try:
             _ = self.ops.pop(opkey)
         except:
@@ -375,9 +1074,14 @@ class ExtensionHandler:
         return self.links
         
     def add_log(self, title, details={}, is_error=False):
-        link = gen_log_link()
-        print(f"{title}: {details}")
-        self.logs.append(gen_log(title, details, is_error, link))
+        record = log("ERROR" if is_error else "INFO", title, details=details)
+        # Past the budget the titles are kept, but their details are left out of the response.
+        # The record already holds details serialized, so its size stands in for theirs
+        details_bytes = len(record) if record else len(json.dumps(details, default=defaultconverter))
+        self.log_bytes += details_bytes
+        if self.log_bytes > int(lambda_env("CK_LOG_MAX_BYTES") or LOG_MAX_BYTES):
+            details = {"omitted_bytes": details_bytes}
+        self.logs.append(gen_log(title, details, is_error, gen_log_link()))
 
     def perm_error(self, error, progress=0):
         return self.declare_return(200, progress, error_code=error, callback=False)
@@ -385,8 +1089,19 @@ class ExtensionHandler:
     def retry_error(self, error, progress=0, callback_sec=0):
         return self.declare_return(200, progress, error_code=error, callback_sec=callback_sec)
 
+    def snapshot_ops(self):
+        return json.dumps(self.ops, sort_keys=True, default=defaultconverter)
+
+    def continue_later(self, progress=0):
+        """Ends the invocation with an immediate callback, keeping the ops as they are. 
+        For work cut short by the deadline, so unlike retry_error it counts against no retry 
+        limit, as long as the ops checkpointed some progress since the event came in"""
+        log("INFO", "Continuing After Deadline", remaining_sec=remaining_sec())
+        self.continuation = True
+        return self.declare_return(200, progress, error_code="Continuing After Deadline", callback_sec=1)
+
     def declare_return(self, status_code, progress, success=None, props=None, links=None, error_code=None, error_details=None, callback=True, callback_sec=0):
-        print(f"Calling back to CK, success = {success}, error_code = {error_code}")
+        log("INFO", "Calling back to CK", success=success, error_code=error_code)
         self.status_code = status_code
         self.progress = progress
         self.success = success
@@ -400,22 +1115,47 @@ class ExtensionHandler:
         
     def finish(self):
         pass_back_data = {}
+        if self.continuation and self.snapshot_ops() == self.ops_snapshot:
+            # Cut short without checkpointing anything, so it is counted and scheduled like any retry
+            self.continuation = False
+            self.callback_sec = 0
+
         if self.error:
+            key = retry_key(self.error)
+            policy = RETRY_POLICIES[retry_class(self.error)]
+            if self.continuation:
+                this_retries, max_retries, within_budget = 0, 1, True
+            else:
+                this_retries = self.retries.get(key, 0) + 1
+                self.retries[key] = this_retries
+                max_retries = policy["max_retries"] or self.max_retries_per_error_code
+                # The budget covers every error across the whole chain of callbacks
+                within_budget = sum(self.retries.values()) <= self.retry_budget
             pass_back_data['ops'] = self.ops
             pass_back_data['retries'] = self.retries
-            this_retries = pass_back_data['retries'].get(self.error, 0) + 1
-            pass_back_data['retries'][self.error] = this_retries
+            pass_back_data['retry_delays'] = self.retry_delays
             pass_back_data['props'] = self.props
             pass_back_data['links'] = self.links
             pass_back_data['state'] = self.state
             if self.children:
                 pass_back_data.update(self.children)
-            if this_retries < self.max_retries_per_error_code and self.callback:
+            if this_retries < max_retries and within_budget and self.callback:
                 pass_back_data['last_retry'] = self.error
                 self.error = None
                 self.error_details = None
                 if not self.callback_sec:
-                    self.callback_sec = 2**this_retries                
+                    self.callback_sec = decorrelated_jitter(
+                        policy["base_sec"], policy["cap_sec"], self.retry_delays.get(key, policy["base_sec"])
+                    )
+                    self.retry_delays[key] = self.callback_sec
+            elif self.callback and not within_budget:
+                log("WARNING", "Retry Budget Exhausted", retry_budget=self.retry_budget, retries=self.retries)
+
+            pass_back_data, encoded_bytes = encode_pass_back_data(pass_back_data)
+            max_bytes = int(lambda_env("CK_PASS_BACK_DATA_MAX_BYTES") or PASS_BACK_DATA_MAX_BYTES)
+            # Dropping ops would make them start over on every callback, so oversized state is still sent
+            log("ERROR" if encoded_bytes > max_bytes else "INFO", "Encoded Pass Back Data", 
+                encoded_bytes=encoded_bytes, max_bytes=max_bytes, compressed="zdata" in pass_back_data)
 
         elif not self.success and not self.ignore_undelared_return:
             self.error = "no_success_or_error"
@@ -427,11 +1167,45 @@ class ExtensionHandler:
 
 #       self.logs.sort(key=sort_f, reverse=True)
             
-        return creturn(
+        if any(bucket["waits"] for buckets in rate_limiter_metrics().values() for bucket in buckets.values()):
+            log("INFO", "Rate Limiter", metrics=rate_limiter_metrics())
+
+        response = creturn(
             self.status_code, self.progress, self.success, self.error, self.logs, 
             pass_back_data, self.state or None, self.props, self.links, self.callback_sec, self.error_details
         )
+        logger.flush()
+        return response
     
+class ContextExtensionHandler:
+    """Stands in for an ExtensionHandler whose state belongs to the current event.
+    capture_event binds a fresh ExtensionHandler to the running contextvars 
+    context, so events handled at the same time in one process (each in its 
+    own context, see run_batch) never see each other's state"""
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, "_kwargs", kwargs)
+        object.__setattr__(self, "_handler", contextvars.ContextVar(f"extension_handler_{id(self)}"))
+
+    def current(self):
+        handler = self._handler.get(None)
+        if handler is None:
+            handler = ExtensionHandler(**self._kwargs)
+            self._handler.set(handler)
+        return handler
+
+    def capture_event(self, event, context=None):
+        handler = ExtensionHandler(**self._kwargs)
+        self._handler.set(handler)
+        logger.sample()
+        handler.capture_event(event, context)
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.current(), name, value)
+
 # A decorator
 def ext(f=None, handler=None, op=None, complete_op=True):
     import functools
@@ -449,25 +1223,45 @@ def ext(f=None, handler=None, op=None, complete_op=True):
 
     @functools.wraps(f)
     def the_wrapper_around_the_original_function(*args, **kwargs):
+        # Resolve the handler for this event once, not on every attribute access
+        event_handler = handler.current() if isinstance(handler, ContextExtensionHandler) else handler
         try:
-            if handler.ret:
+            if event_handler.ret:
                 return None
-            elif op and op not in handler.ops.keys():
+            elif op and op not in event_handler.ops.keys():
                 # prin(f"Not trying function {f.__name__}, not in ops")
                 return None
         except:
             raise Exception(f"Must pass handler of type ExtensionHandler to ext decorator")
 
-        result = f(*args, **kwargs)
-        if complete_op and not handler.ret:
-            handler.complete_op(op)
+        if out_of_time():
+            event_handler.continue_later(event_handler.progress or 0)
+            return None
+
+        try:
+            result = f(*args, **kwargs)
+        except DeadlineReached:
+            # A call waiting on the rate limiter would have run into the deadline margin
+            event_handler.continue_later(event_handler.progress or 0)
+            return None
+        if complete_op and not event_handler.ret:
+            event_handler.complete_op(op)
         return result
 
     return the_wrapper_around_the_original_function
 
+_log_link_prefix = None
+
+def log_link_prefix():
+    """The log stream never changes within a container, so the link is only built once"""
+    global _log_link_prefix
+    if _log_link_prefix is None:
+        log_event_encoded = quote(quote(lambda_env("AWS_LAMBDA_LOG_STREAM_NAME"), safe=''), safe='').replace("%", "$")
+        region = lambda_env("AWS_DEFAULT_REGION")
+        _log_link_prefix = f"https://{region}.console.aws.amazon.com/cloudwatch/home?region={region}#logsV2:log-groups/log-group/$252Faws$252Flambda$252F{os.environ['AWS_LAMBDA_FUNCTION_NAME']}/log-events/{log_event_encoded}$3Fstart$3D"
+    return _log_link_prefix
+
 def gen_log_link():
-    log_event_encoded = quote(quote(lambda_env("AWS_LAMBDA_LOG_STREAM_NAME"), safe=''), safe='').replace("%", "$")
-    region = lambda_env("AWS_DEFAULT_REGION")
     # Get milliseconds since epoch
     millis = int(round(time.time() * 1000)) - 50
-    return f"https://{region}.console.aws.amazon.com/cloudwatch/home?region={region}#logsV2:log-groups/log-group/$252Faws$252Flambda$252F{os.environ['AWS_LAMBDA_FUNCTION_NAME']}/log-events/{log_event_encoded}$3Fstart$3D{millis}"
+    return f"{log_link_prefix()}{millis}"
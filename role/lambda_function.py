@@ -1,11 +1,12 @@
-import boto3
 import botocore
 # import jsonschema
 import json
 import traceback
 
-from extutil import remove_none_attributes, account_context, ExtensionHandler, \
-    ext, component_safe_name
+from extutil import remove_none_attributes, account_context, ContextExtensionHandler, get_client, \
+    component_def_error, ext, run_batch, component_safe_name, normalize_policy_document, compact_json, policy_document_errors, \
+    diff_tags, write_tags, delete_tags, paginate, run_concurrently, log, summarize_response, \
+    deferred_items, DeadlineReached, summary_error, MAX_TRUST_POLICY_CHARS
 
 # def validate_state(state):
 # "prev_state": prev_state,
@@ -14,16 +15,31 @@ from extutil import remove_none_attributes, account_context, ExtensionHandler, \
 # "s3_object_name": object_name,
 # "pass_back_data": pass_back_data
 #     jsonschema.validate()
-eh = ExtensionHandler()
+eh = ContextExtensionHandler()
+# Built once during init, rather than inside the first op or event
+get_client("iam")
+
+POLICY_ARN_CONCURRENCY = 8
+ROLE_LOG_KEYS = ["Arn", "RoleName", "RoleId", "Path", "MaxSessionDuration", "CreateDate"]
 
 def lambda_handler(event, context):
+    if "batch" in event:
+        return run_batch(lambda_handler, event, context)
+
     try:
-        print(f"event = {event}")
+        log("DEBUG", "Event", event=event)
         account_number = account_context(context)['number']
-        eh.capture_event(event)
+        eh.capture_event(event, context)
 
         prev_state = event.get("prev_state")
         cdef = event.get("component_def")
+        if event.get("op") == "upsert":
+            input_error = component_def_error("role", cdef)
+            if input_error:
+                eh.add_log("Invalid Component Definition", {"error": input_error}, True)
+                eh.perm_error(f"Invalid Component Definition: {input_error}", 0)
+                return eh.finish()
+
         cname = event.get("component_name")
         project_code = event.get("project_code")
         repo_id = event.get("repo_id")
@@ -33,12 +49,19 @@ def lambda_handler(event, context):
         policy_arns = cdef.get("policy_arns") or []
         role_name = cdef.get("name") or component_safe_name(project_code, repo_id, cname)
         basic_lambda_policy = set(["arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"]) if cdef.get("include_basic_lambda_policy", True) else set()
-        desired_policy_arns = list(set(policy_arns) | set(map(lambda x: x['arn'], policies)) | basic_lambda_policy)
-        print(f"desired_policy_arns = {desired_policy_arns}")
+        desired_policy_arns = list(set(policy_arns) | set(arn for policy in policies for arn in (policy.get('shard_arns') or [policy['arn']])) | basic_lambda_policy)
+        log("DEBUG", "Desired Policy Arns", desired_policy_arns=desired_policy_arns)
         role_services = cdef.get("role_services") or ["lambda"]
         
         tags = cdef.get("tags") or {}
         pass_back_data = event.get("pass_back_data", {})
+        if event.get("op") == "upsert":
+            document_errors = policy_document_errors(create_assume_role_policy(role_services), trust_policy=True, max_chars=MAX_TRUST_POLICY_CHARS)
+            if document_errors:
+                eh.add_log("Invalid Assume Role Policy", {"errors": document_errors}, True)
+                eh.perm_error(f"Invalid Assume Role Policy: {'; '.join(document_errors)}", 0)
+                return eh.finish()
+
         if pass_back_data:
             pass
         elif event.get("op") == "upsert":
@@ -51,7 +74,7 @@ def lambda_handler(event, context):
         create_role(role_name, description, tags, role_services, cname, account_number)
         update_role(role_name, description, max_session_duration_seconds)
         remove_tags(role_name)
-        add_tags(role_name, tags)
+        add_tags(role_name)
         add_policy_arns(role_name)
         remove_policy_arns(role_name)
         update_assume_role_policy(role_name, role_services)
@@ -61,7 +84,6 @@ def lambda_handler(event, context):
 
     except Exception as e:
         msg = traceback.format_exc()
-        print(msg)
         eh.add_log("Unexpected Error", {"error": msg}, is_error=True)
         eh.declare_return(200, 0, error_code=str(e))
         return eh.finish()
@@ -82,23 +104,10 @@ def get_role(prev_state, role_name, role_services, desired_policy_arns, descript
     except:
         pass
 
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
 
     try:
-        role_response = iam_client.get_role(RoleName=role_name).get("Role")
-        eh.add_log("Got Existing Role", role_response)
-        eh.add_props({
-            "arn": role_response['Arn'],
-            "name": role_response['RoleName'],
-            "role_id": role_response['RoleId']
-        })
-        eh.add_links({"Role": gen_iam_role_link(role_name)})
-
-        old_description = role_response['Description']
-        old_msds = role_response['MaxSessionDuration']
-        if ((description != old_description) or (max_session_duration_seconds != old_msds)):
-            eh.add_op("update_role")
-            
+        snapshot = get_role_snapshot(iam_client, role_name)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchEntity':
             eh.add_log("Role Does Not Exist", {"error": str(e)})
@@ -110,195 +119,232 @@ def get_role(prev_state, role_name, role_services, desired_policy_arns, descript
             eh.retry_error(str(e))
             return None
 
-    try:
-        response = iam_client.list_attached_role_policies(
-            RoleName=role_name,
-            MaxItems=10
-        )
-        attached_policy_arns = list(map(lambda x: x['PolicyArn'], response.get("AttachedPolicies")))
-        eh.add_log("Got Role Policies", response)
-        add_arns = list(set(desired_policy_arns)-set(attached_policy_arns))
-        remove_policy_arns = list(set(attached_policy_arns)-set(desired_policy_arns))
-        if add_arns:
-            eh.add_op("add_policy_arns", add_arns)
-        if remove_policy_arns:
-            eh.add_op("remove_policy_arns", remove_policy_arns)
-
-    except botocore.exceptions.ClientError as e:
-        eh.add_log("Get Role Policies Failed", str(e), True)
-        eh.retry_error(str(e))
-        return None
-
-    try:
-        tags = {}
-        first = True
-        cursor = None
-        while first or cursor:
-            first = False
-            params = remove_none_attributes({
-                "RoleName": role_name,
-                "Marker": cursor
-            })
-            response = iam_client.list_role_tags(**params)
-            print(f"tags_response = {response}")
-            tags.update({
-                item["Key"]: item["Value"]
-                for item in response.get("Tags")
-            })
-            if response.get("IsTruncated"):
-                cursor = response.get("Marker")
-
-        eh.add_log("Got Tags", {"tags": tags})
-        if tags != desired_tags:
-            eh.add_op("add_tags")
-        old_keys = list(set(tags.keys()) - set(desired_tags.keys()))
-        if old_keys:
-            eh.add_op("remove_tags", old_keys)
+    role_response = snapshot['role']
+    eh.add_log("Got Existing Role", summarize_response(role_response, ROLE_LOG_KEYS))
+    eh.add_props({
+        "arn": role_response['Arn'],
+        "name": role_response['RoleName'],
+        "role_id": role_response['RoleId'],
+        "role_services": role_services
+    })
+    eh.add_links({"Role": gen_iam_role_link(role_name)})
+
+    old_description = role_response.get('Description')
+    old_msds = role_response.get('MaxSessionDuration')
+    if ((description != old_description) or (max_session_duration_seconds != old_msds)):
+        eh.add_op("update_role")
+
+    attached_policy_arns = snapshot['attached_policy_arns']
+    eh.add_log("Got Role Policies", {"policy_arns": attached_policy_arns})
+    add_arns = list(set(desired_policy_arns)-set(attached_policy_arns))
+    remove_policy_arns = list(set(attached_policy_arns)-set(desired_policy_arns))
+    if add_arns:
+        eh.add_op("add_policy_arns", add_arns)
+    if remove_policy_arns:
+        eh.add_op("remove_policy_arns", remove_policy_arns)
+
+    tags = snapshot['tags']
+    eh.add_log("Got Tags", {"tags": tags})
+    add_tags, remove_tags = diff_tags(tags, desired_tags)
+    if add_tags:
+        eh.add_op("add_tags", add_tags)
+    if remove_tags:
+        eh.add_op("remove_tags", remove_tags)
+
+    existing_principals = assume_role_principals(snapshot['assume_role_policy'])
+    desired_principals = assume_role_principals(create_assume_role_policy(role_services))
+    if existing_principals != desired_principals:
+        eh.add_log("Assume Role Policy Changed", {
+            "added": sorted(desired_principals - existing_principals),
+            "removed": sorted(existing_principals - desired_principals)
+        })
+        eh.add_op("update_role_services")
 
-    except botocore.exceptions.ClientError as e:
-        eh.add_log("Error Getting Tags", str(e), True)
-        eh.retry_error(str(e))
-        return None
+def get_role_snapshot(iam_client, role_name):
+    """Reads everything get_role reconciles against. GetRole already returns 
+    the trust policy and tags, so only the attached policies need another call"""
+    role = iam_client.get_role(RoleName=role_name)['Role']
 
-    try:
-        iam = boto3.resource('iam')
-        role = iam.Role(role_name)
-        existing_document = role.assume_role_policy_document
-        print(f"existing_document = {existing_document}")
-        desired_document = create_assume_role_policy(role_services)
-        print(f"desired document = {desired_document}")
-        if existing_document != desired_document:
-            eh.add_op("update_role_services")
-
-    except botocore.exceptions.ClientError as e:
-        eh.add_log("Error Getting Assume Role Policy", str(e), True)
-        eh.retry_error(str(e))
-        return None
+    attached_policies = paginate(iam_client.list_attached_role_policies, "AttachedPolicies", RoleName=role_name)
 
+    return {
+        "role": role,
+        # GetRole leaves Tags out entirely when the role has none
+        "tags": {item["Key"]: item["Value"] for item in role.get("Tags") or []},
+        "assume_role_policy": role.get("AssumeRolePolicyDocument") or {},
+        "attached_policy_arns": [p['PolicyArn'] for p in attached_policies]
+    }
 
 @ext(handler=eh, op="remove_old")
 def remove_role():
-    iam_client = boto3.client("iam")
-    role_name = eh.ops['remove_old'].get("name")
-    car = eh.ops['remove_old'].get("create_and_remove")
-    list_response = {}
-    
-    try:
-        list_response = iam_client.list_attached_role_policies(
-            RoleName=role_name
-        )
-        print(f"list_response = {list_response}")
+    """Clears every kind of dependency IAM requires gone before DeleteRole, 
+    listing and removing them concurrently. Each kind is checkpointed in the 
+    op once cleared, so a retry only revisits what is left"""
+    iam_client = get_client("iam")
+    op_info = eh.ops['remove_old']
+    role_name = op_info.get("name")
+    car = op_info.get("create_and_remove")
+    cleared = op_info.setdefault("cleared", [])
+
+    listers = {
+        "managed_policies": lambda: [p['PolicyArn'] for p in paginate(iam_client.list_attached_role_policies, "AttachedPolicies", RoleName=role_name)],
+        "inline_policies": lambda: list(paginate(iam_client.list_role_policies, "PolicyNames", RoleName=role_name)),
+        "instance_profiles": lambda: [p['InstanceProfileName'] for p in paginate(iam_client.list_instance_profiles_for_role, "InstanceProfiles", RoleName=role_name)]
+    }
+    removers = {
+        "managed_policies": lambda arn: call_ignoring_missing(iam_client.detach_role_policy, RoleName=role_name, PolicyArn=arn),
+        "inline_policies": lambda name: call_ignoring_missing(iam_client.delete_role_policy, RoleName=role_name, PolicyName=name),
+        "instance_profiles": lambda name: call_ignoring_missing(iam_client.remove_role_from_instance_profile, RoleName=role_name, InstanceProfileName=name)
+    }
 
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] in ['NoSuchEntityException', 'NoSuchEntity']:
+    kinds = [kind for kind in listers.keys() if kind not in cleared]
+    listings = run_concurrently(lambda kind: listers[kind](), kinds, max_workers=len(listers))
+    if deferred_items(listings):
+        eh.continue_later(97 if car else 20)
+        return None
+    for kind, _, error in listings:
+        if not error:
+            continue
+        elif isinstance(error, botocore.exceptions.ClientError) and error.response['Error']['Code'] in ['NoSuchEntityException', 'NoSuchEntity']:
             eh.add_log(f"Role Does Not Exist", {"role_name": role_name})
             eh.complete_op("remove_old")
             return None
         else:
-            eh.add_log(f"Error Listing Role Policies", {"error": str(e)}, True)
-            eh.retry_error(str(e), 97 if car else 20)
+            eh.add_log("Error Listing Role Dependencies", {"kind": kind, "error": str(error)}, True)
+            eh.retry_error(str(error), 97 if car else 20)
             return None
 
-    for policy in list_response.get("AttachedPolicies", []):
-        try:
-            response = iam_client.detach_role_policy(
-                RoleName = role_name,
-                PolicyArn = policy['PolicyArn']
-            )
-            eh.add_log(f"Detaching From Role", {"policy_arn": policy['PolicyArn']})
-
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchEntityException':
-                pass
-            else:
-                eh.retry_error(str(e), 98 if car else 40)
+    dependencies = [(kind, item) for kind, items, _ in listings for item in items]
+    results = run_concurrently(
+        lambda dependency: removers[dependency[0]](dependency[1]),
+        dependencies, max_workers=POLICY_ARN_CONCURRENCY
+    )
+    failed = {f"{kind}/{item}": str(error) for (kind, item), _, error in results if error and not isinstance(error, DeadlineReached)}
+    unfinished = set(kind for kind, _ in deferred_items(results)) | set(k.split("/", 1)[0] for k in failed)
+    cleared.extend(kind for kind in kinds if kind not in unfinished)
+    if dependencies:
+        eh.add_log("Removed Role Dependencies", {
+            "removed": [f"{kind}/{item}" for (kind, item), _, error in results if not error],
+            "failed": failed
+        }, bool(failed))
+    if failed:
+        eh.retry_error(summary_error(f"Failed to remove {len(failed)} dependencies from role", [error for _, _, error in results]), 98 if car else 40)
+        return None
+    elif unfinished:
+        eh.continue_later(98 if car else 40)
+        return None
 
     try:
-        role_response = iam_client.delete_role(
+        iam_client.delete_role(
             RoleName = role_name
         )
-        eh.add_log("Deleted Role", role_response)
+        eh.add_log("Deleted Role", {"role_name": role_name})
 
     except botocore.exceptions.ClientError as e:
-        eh.add_log("Error Deleting Role", {"error": str(e)}, is_error=True)
-        eh.retry_error(str(e), 99 if car else 60)
+        if e.response['Error']['Code'] in ['NoSuchEntityException', 'NoSuchEntity']:
+            eh.add_log(f"Role Does Not Exist", {"role_name": role_name})
+        elif e.response['Error']['Code'] == 'DeleteConflict':
+            # Something was attached after we listed, so list everything again
+            op_info['cleared'] = []
+            eh.add_log("Role Still Has Dependencies", {"error": str(e)}, is_error=True)
+            eh.retry_error(str(e), 99 if car else 60)
+        else:
+            eh.add_log("Error Deleting Role", {"error": str(e)}, is_error=True)
+            eh.retry_error(str(e), 99 if car else 60)
 
 
 @ext(handler=eh, op="add_policy_arns")
 def add_policy_arns(role_name):
-    iam_client = boto3.client("iam")
-    add_policy_arns = eh.ops['add_policy_arns']
-    iter_add_policy_arns = list(add_policy_arns)
-
-    for add_policy_arn in iter_add_policy_arns:
-        try:
-            attach_response = iam_client.attach_role_policy(
-                RoleName=role_name,
-                PolicyArn=add_policy_arn
-            )
-            eh.ops['add_policy_arns'].remove(add_policy_arn)
-            eh.add_log("Added Policy to Role", {"ARN": add_policy_arn, "response": attach_response})
-        except botocore.exceptions.ClientError as e:
-            eh.add_log("Add Policy Error", {"error": str(e)}, True)
-            eh.retry_error(str(e), 60)
+    iam_client = get_client("iam")
+    journal = policy_arn_journal("add_policy_arns")
+    pending = [arn for arn, result in journal.items() if result != "attached"]
+
+    results = run_concurrently(
+        lambda arn: iam_client.attach_role_policy(RoleName=role_name, PolicyArn=arn),
+        pending, max_workers=POLICY_ARN_CONCURRENCY
+    )
+    for arn, _, error in results:
+        if not isinstance(error, DeadlineReached):
+            journal[arn] = str(error) if error else "attached"
+
+    failed = [arn for arn, _, error in results if error and not isinstance(error, DeadlineReached)]
+    eh.add_log("Added Policies to Role", {"results": journal}, bool(failed))
+    if failed:
+        eh.retry_error(summary_error(f"Failed to attach {len(failed)} policies to role", [error for _, _, error in results]), 60)
+    elif deferred_items(results):
+        eh.continue_later(60)
     
 
 @ext(handler=eh, op="remove_policy_arns")
 def remove_policy_arns(role_name):
-    iam_client = boto3.client("iam")
-    remove_policy_arns = eh.ops['remove_policy_arns']
-
-    for remove_policy_arn in remove_policy_arns:
-        try:
-            remove_response = iam_client.detach_role_policy(
-                RoleName=role_name,
-                PolicyArn=remove_policy_arn
-            )
-            eh.ops['add_policy_arns'].remove(remove_policy_arn)
-            eh.add_log("Removed Policy From Role", {"ARN": remove_policy_arn, "response": remove_response})
-
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchEntity':
-                eh.ops['add_policy_arns'].remove(remove_policy_arn)
-                pass
-            else:
-                eh.add_log("Remove Policy Error", {"error": str(e)}, True)
-                eh.retry_error(str(e), 90)
+    iam_client = get_client("iam")
+    journal = policy_arn_journal("remove_policy_arns")
+    pending = [arn for arn, result in journal.items() if result != "detached"]
+
+    results = run_concurrently(
+        lambda arn: call_ignoring_missing(iam_client.detach_role_policy, RoleName=role_name, PolicyArn=arn),
+        pending, max_workers=POLICY_ARN_CONCURRENCY
+    )
+    for arn, _, error in results:
+        if not isinstance(error, DeadlineReached):
+            journal[arn] = str(error) if error else "detached"
+
+    failed = [arn for arn, _, error in results if error and not isinstance(error, DeadlineReached)]
+    eh.add_log("Removed Policies From Role", {"results": journal}, bool(failed))
+    if failed:
+        eh.retry_error(summary_error(f"Failed to detach {len(failed)} policies from role", [error for _, _, error in results]), 90)
+    elif deferred_items(results):
+        eh.continue_later(90)
+
+def policy_arn_journal(op_key):
+    """get_role queues a list of ARNs. The first run turns it into a journal 
+    of ARN -> result kept in the op, so a retry only re-attempts the ARNs 
+    that have not succeeded yet"""
+    journal = eh.ops[op_key]
+    if isinstance(journal, list):
+        journal = {arn: None for arn in journal}
+        eh.ops[op_key] = journal
+    return journal
+
+def call_ignoring_missing(method, **params):
+    """For removals, where something already being gone counts as success"""
+    try:
+        method(**params)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchEntity', 'NoSuchEntityException']:
+            raise e
 
 @ext(handler=eh, op="update_role_services")
 def update_assume_role_policy(role_name, role_services):
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
 
     assume_role_policy = create_assume_role_policy(role_services)
 
     try:
-        policy_response = iam_client.update_assume_role_policy(
+        iam_client.update_assume_role_policy(
             RoleName=role_name,
-            PolicyDocument=json.dumps(assume_role_policy)
+            PolicyDocument=compact_json(assume_role_policy)
         )
-        eh.add_log("Updated Assume Role Policy", policy_response)
+        eh.add_log("Updated Assume Role Policy", {"role_name": role_name, "role_services": role_services})
     except botocore.exceptions.ClientError as e:
         eh.add_log("Assume Role Policy Error", {"error": str(e)}, True)
         eh.retry_error(str(e), 95)
 
 @ext(handler=eh, op="add_tags")
-def add_tags(role_name, tags):
-    iam_client = boto3.client("iam")
-
-    formatted_tags = format_tags(tags)
+def add_tags(role_name):
+    iam_client = get_client("iam")
+    tags = eh.ops['add_tags']
 
     try:
-        response = iam_client.tag_role(
-            RoleName=role_name,
-            Tags=formatted_tags
-        )
-        eh.add_log("Tags Set", response)
+        written = dict(tags)
+        write_tags(lambda batch: iam_client.tag_role(RoleName=role_name, Tags=batch), tags)
+        eh.add_log("Tags Set", {"tags": written})
 
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] in ["LimitExceededException"]:
+        if e.response['Error']['Code'] in ["LimitExceeded", "LimitExceededException"]:
             eh.add_log("Tag Limit Hit", {"tags": tags, "role_name": role_name}, True)
             eh.perm_error("Tag Limit Hit", 50)
-        elif e.response['Error']['Code'] in ["InvalidInputException"]:
+        elif e.response['Error']['Code'] in ["InvalidInput", "InvalidInputException"]:
             eh.add_log("Invalid Tags", {"tags": tags, "role_name": role_name}, True)
             eh.perm_error("Invalid Tags", 50)
         else:
@@ -308,31 +354,29 @@ def add_tags(role_name, tags):
 
 @ext(handler=eh, op="remove_tags")
 def remove_tags(role_name):
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
     remove_tags = eh.ops['remove_tags']
 
     try:
-        response = iam_client.untag_role(
-            RoleName=role_name,
-            TagKeys=remove_tags
-        )
-        eh.add_log("Tags Removed", {"tags_removed": remove_tags})
+        removed = list(remove_tags)
+        delete_tags(lambda batch: iam_client.untag_role(RoleName=role_name, TagKeys=batch), remove_tags)
+        eh.add_log("Tags Removed", {"tags_removed": removed})
 
     except botocore.exceptions.ClientError as e:
         eh.add_log("Remove Tags Error", {"error": str(e)}, True)
         eh.retry_error(str(e), 40)
-        
+
 
 @ext(handler=eh, op="create_role")
 def create_role(role_name, description, tags, role_services, component_name, account_number):
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
     assume_role_policy = create_assume_role_policy(role_services)
 
     try:
         role_params = remove_none_attributes({
             "Path": "/cloudkommand/",
             "RoleName": role_name,
-            "AssumeRolePolicyDocument": json.dumps(assume_role_policy),
+            "AssumeRolePolicyDocument": compact_json(assume_role_policy),
             "Description": description or f"CK role for component {component_name}",
             "Tags": format_tags(tags) or None
         })
@@ -341,11 +385,11 @@ def create_role(role_name, description, tags, role_services, component_name, acc
         eh.add_props({
             "arn": role_response['Arn'],
             "name": role_response['RoleName'],
-            "role_id": role_response['RoleId']
-            # "role_services": assume_role_policy.get("Statement")[0]
+            "role_id": role_response['RoleId'],
+            "role_services": role_services
             })
         eh.add_links({"Role": gen_iam_role_link(role_name)})
-        eh.add_log("Created New Role", role_response)
+        eh.add_log("Created New Role", summarize_response(role_response, ROLE_LOG_KEYS))
 
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'EntityAlreadyExists':
@@ -360,15 +404,15 @@ def create_role(role_name, description, tags, role_services, component_name, acc
 
 @ext(handler=eh, op="update_role")
 def update_role(role_name, description, max_session_duration_seconds):
-    iam_client = boto3.client("iam")
+    iam_client = get_client("iam")
 
     try:
-        response = iam_client.update_role(
+        iam_client.update_role(
             RoleName=role_name,
             Description=description,
             MaxSessionDuration=max_session_duration_seconds
         )
-        eh.add_log("Updated Role", response)
+        eh.add_log("Updated Role", {"role_name": role_name, "max_session_duration_seconds": max_session_duration_seconds})
     
         # add_arns = list(set(desired_policy_arns)-set(attached_policy_arns)) or None
         # remove_policy_arns = list(set(attached_policy_arns)-set(desired_policy_arns)) or None
@@ -391,7 +435,7 @@ def create_assume_role_policy(role_services):
         CloudFormation would attach to a lambda's role
     '''
     #ldkfjd
-    in_policy_services = list(map(lambda x: (x if x.endswith(".amazonaws.com") else f"{x}.amazonaws.com"), role_services))
+    in_policy_services = sorted(set(map(lambda x: (x if x.endswith(".amazonaws.com") else f"{x}.amazonaws.com"), role_services)))
     if len(in_policy_services) == 1:
         in_policy_services = in_policy_services[0]
     return {
@@ -405,6 +449,22 @@ def create_assume_role_policy(role_services):
             "Action": "sts:AssumeRole"
         }]}
 
+def assume_role_principals(document):
+    """Flattens a trust policy into a set of (Effect, Action, principal type, principal, Condition) 
+    grants, so that service order, single item lists, Sids and how the 
+    grants are split across statements do not count as changes"""
+    principals = set()
+    for statement in normalize_policy_document(document or {})["Statement"]:
+        statement_principals = statement.get("Principal") or {}
+        if not isinstance(statement_principals, dict):
+            statement_principals = {"*": [statement_principals]}
+        condition = json.dumps(statement.get("Condition") or {}, sort_keys=True)
+        for action in statement.get("Action") or []:
+            for principal_type, values in statement_principals.items():
+                for value in values:
+                    principals.add((statement.get("Effect"), action, principal_type, value, condition))
+    return principals
+
 def gen_iam_policy_arn(policy_name, account_number, path="/"):
     #arn:aws:iam::227993477930:policy/3aba481ac88bcbc5d94567e9f93339a7-iam
     return f"arn:aws:iam::{account_number}:policy{path}{policy_name}"